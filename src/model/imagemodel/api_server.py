@@ -1,13 +1,20 @@
 # api_server.py
 
-from fastapi import FastAPI, HTTPException
-from fastapi.concurrency import run_in_threadpool
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, Response, FileResponse
 from pydantic import BaseModel, Field, constr, field_validator
-import uvicorn, traceback, base64, binascii
+import uvicorn, traceback, base64, json, re
 import config
 from logger import setup_logger
-from pipeline import ImageGenerationPipeline
+from pipeline import ImageGenerationPipeline, InputImageError
+from prompt_utils import get_llm_cache
+from batcher import MicroBatcher
+from jobs import JobManager, QueueFullError, TERMINAL_EVENTS
 from typing import Literal
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+_BASE64_RE = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+MAX_UPLOAD_BYTES = getattr(config, "INPUT_MAX_BYTES", 25 * 1024**2)
 
 # Pydantic 모델
 class Params(BaseModel):
@@ -18,6 +25,13 @@ class Params(BaseModel):
     model_alias: str | None = None
     file_saved: bool = False
     seed: int | None = None
+    use_background_library: bool = True
+    output_format: Literal["png", "webp", "jpeg"] = Field("png", description="최종 이미지 인코딩 포맷")
+    output_quality: int | None = Field(None, ge=1, le=100, description="WebP/JPEG 인코딩 품질 (기본 90, PNG는 무시)")
+    quality: Literal["draft", "standard", "premium"] | None = Field(None, description="생성 품질 티어: 스케줄러/스텝 수/리파이너 사용 (기본: 서버 설정 DEFAULT_QUALITY)")
+    denoising_end: float | None = Field(None, gt=0, lt=1, description="base→리파이너 분할 지점 (ensemble-of-experts). 미지정 시 서버 설정 ENSEMBLE_DENOISING_END, 그것도 없으면 기존 img2img 리파인")
+    artifact_level: Literal["none", "key", "all"] | None = Field(None, description="디버그 산출물 저장 수준 (기본: 서버 설정 ARTIFACT_LEVEL)")
+    timings: bool = Field(False, description="True면 응답에 단계별 실행 시간/GPU 시간/최대 GPU 메모리(timings)를 포함")
 
 class ImageGenerationRequest(BaseModel):
     prompt: str = Field(..., description="프롬프트 문장")
@@ -29,46 +43,169 @@ class ImageGenerationRequest(BaseModel):
     def validate_base64(cls, v: str | None):
         if v is None: return None
         
-        try:
-            if ',' in v:
-                v = v.split(',', 1)[1]
-            
-            missing_padding = len(v) % 4
-            if missing_padding:
-                v += '=' * (4 - missing_padding)
-            
-            base64.b64decode(v, validate=True)
-            return v
-        except (binascii.Error, IndexError, TypeError) as e:
-            raise ValueError(f"Invalid base64 string: {e}")
+        if ',' in v:
+            v = v.split(',', 1)[1]
+        
+        missing_padding = len(v) % 4
+        if missing_padding:
+            v += '=' * (4 - missing_padding)
+        
+        # 실제 디코드는 파이프라인에서 한 번만 합니다. 여기서는 문자 집합과 크기만 확인합니다.
+        if not _BASE64_RE.fullmatch(v):
+            raise ValueError("Invalid base64 string")
+        if len(v) * 3 // 4 > MAX_UPLOAD_BYTES:
+            raise ValueError(f"Image exceeds {MAX_UPLOAD_BYTES // 1024**2}MB upload limit")
+        return v
 
 # FastAPI 앱 및 로거 생성
 app = FastAPI(title="Image Generation API", version="1.0.0")
 logger = setup_logger()
 pipeline_instance = None
+batcher = None
+job_manager = None
 
 @app.on_event("startup")
 def load_pipeline():
-    global pipeline_instance
+    global pipeline_instance, batcher
     logger.info("서버 시작: 이미지 생성 파이프라인 로딩...")
     pipeline_instance = ImageGenerationPipeline(config=config, logger=logger)
+    batcher = MicroBatcher(
+        pipeline_instance.run_batch, pipeline_instance.batch_key,
+        window_ms=getattr(config, "IMAGE_BATCH_WINDOW_MS", 50),
+        max_batch_size=getattr(config, "IMAGE_MAX_BATCH_SIZE", 4),
+        logger=logger,
+    )
     logger.info("파이프라인 로딩 완료.")
 
+@app.on_event("startup")
+async def start_job_workers():
+    global job_manager
+    max_batch_size = getattr(config, "IMAGE_MAX_BATCH_SIZE", 4)
+    job_manager = JobManager(
+        lambda input_data: batcher.submit(input_data),
+        workers=getattr(config, "JOB_WORKERS", max_batch_size),
+        max_queue=getattr(config, "JOB_MAX_QUEUE", 100),
+        retention_seconds=getattr(config, "JOB_RETENTION_SECONDS", 3600),
+        max_retained=getattr(config, "JOB_MAX_RETAINED", 500),
+        logger=logger,
+    )
+    job_manager.start()
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    if job_manager: await job_manager.stop()
+
+def _json_result(result: dict) -> dict:
+    if "image_bytes" not in result: return result
+    result = dict(result)
+    result["image_base64"] = base64.b64encode(result.pop("image_bytes")).decode("utf-8")
+    return result
+
+def _render_result(result: dict, request: Request):
+    """Accept 헤더에 image/*가 있으면 이미지 바이트를 그대로, 아니면 base64 JSON으로 응답합니다."""
+    if "image/" in request.headers.get("accept", ""):
+        headers = {"X-Seed": str(result.get("seed"))}
+        if "timings" in result:
+            headers["Server-Timing"] = ", ".join(f"{name};dur={s['wall_ms']}" for name, s in result["timings"]["stages"].items())
+        if "image_bytes" in result:
+            return Response(content=result["image_bytes"], media_type=result["mime_type"], headers=headers)
+        if "filepath" in result:
+            return FileResponse(result["filepath"], media_type=result["mime_type"], headers=headers)
+    return _json_result(result)
+
 @app.get("/")
 def health_check():
-    return {"status": "ok" if pipeline_instance else "loading"}
+    if not pipeline_instance:
+        return {"status": "loading"}
+    return {"status": "ok", "jobs": job_manager.stats() if job_manager else None, "model_cache": pipeline_instance.model_manager.stats(), "stages": pipeline_instance.stages.stats(), "cutout_cache": pipeline_instance.cutout_cache.stats(), "rembg": pipeline_instance.rembg_sessions.stats() if pipeline_instance.rembg_sessions else None, "outputs": pipeline_instance.output_store.stats(), "result_cache": pipeline_instance.result_cache.stats() if pipeline_instance.result_cache else None, "llm_cache": get_llm_cache().stats() if get_llm_cache() else None}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus 수집용 단계별 시간/GPU 메모리 히스토그램."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.post("/generate_image")
-async def generate_image(request: ImageGenerationRequest):
+async def generate_image(request: ImageGenerationRequest, http_request: Request):
+    """
+    이미지 생성 (동기). 기본 응답은 JSON(image_base64 또는 filepath)이고,
+    Accept: image/* 로 요청하면 params.output_format 포맷의 이미지 바이트를 그대로 돌려줍니다.
+    """
     if not pipeline_instance:
         raise HTTPException(status_code=503, detail="서버가 준비 중입니다.")
     try:
         input_data = request.model_dump()
-        result = await run_in_threadpool(pipeline_instance.run, input_data)
-        return result
+        result = await batcher.submit(input_data)
+        return _render_result(result, http_request)
+    except InputImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error during image generation: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail="이미지 생성 중 내부 서버 오류 발생")
 
+@app.post("/jobs", status_code=202)
+async def submit_job(request: ImageGenerationRequest):
+    if not (pipeline_instance and job_manager):
+        raise HTTPException(status_code=503, detail="서버가 준비 중입니다.")
+    try:
+        job = job_manager.submit(request.model_dump())
+    except QueueFullError:
+        raise HTTPException(status_code=429, detail="대기 중인 작업이 너무 많습니다. 잠시 후 다시 시도해주세요.")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id) if job_manager else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="작업을 찾을 수 없습니다.")
+    data = job.to_dict()
+    if "result" in data: data["result"] = _json_result(data["result"])
+    return data
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id) if job_manager else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="작업을 찾을 수 없습니다.")
+    return job.to_dict(include_result=False)
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request):
+    """
+    작업 진행 상황을 SSE로 전달합니다.
+    - event: stage  (prepare / background / compose_prompt / composite / base / refiner)
+    - event: step   ({stage, step, total} + 몇 스텝마다 저해상도 JPEG base64 "preview")
+    - event: done / failed / cancelled  (종료, 결과는 GET /jobs/{id}/result)
+    """
+    job = job_manager.get(job_id) if job_manager else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="작업을 찾을 수 없습니다.")
+
+    async def event_stream():
+        index = 0
+        while not await request.is_disconnected():
+            events = await job.wait_events(index)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            index += len(events)
+            for event in events:
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                if event["type"] in TERMINAL_EVENTS: return
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, request: Request):
+    job = job_manager.get(job_id) if job_manager else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="작업을 찾을 수 없습니다.")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status == "cancelled":
+        raise HTTPException(status_code=410, detail="취소된 작업입니다.")
+    if job.status != "succeeded":
+        raise HTTPException(status_code=409, detail=f"작업이 아직 완료되지 않았습니다. (status={job.status})")
+    return _render_result(job.result, request)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8090)
\ No newline at end of file
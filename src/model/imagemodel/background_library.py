@@ -0,0 +1,120 @@
+# =======================================
+# background_library.py — 템플릿/사이즈별 사전 생성 배경 라이브러리
+# =======================================
+# AI Auto-Layout 모드의 배경 생성(SDXL 25 step)을 요청마다 돌리지 않도록
+# 템플릿 × 사이즈마다 시드 N개의 배경을 미리 만들어 둡니다.
+#
+# 디렉토리 구조: {root}/{template_id}/{W}x{H}/
+#     images.npy   uint8   (N, H, W, 3)
+#     meta.json    {"seeds": [...], "background_prompt": "..."}
+# 런타임에는 np.load(mmap_mode="r")로 열어 필요한 한 장만 페이지 인 합니다.
+# 없는 템플릿/사이즈는 기억하지 않고, meta.json이 바뀌면 다시 열므로 서버 기동 후 생성/동기화한 라이브러리도 바로 쓰입니다.
+#
+# 오프라인 생성:
+#     cd src/model/imagemodel
+#     python background_library.py --count 8 --sizes 1080x1080 1080x1350
+# =======================================
+
+import os
+import json
+import argparse
+import threading
+import numpy as np
+from PIL import Image
+
+DEFAULT_LIBRARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "background_library")
+
+class BackgroundEntry:
+    def __init__(self, image: Image.Image, seed: int):
+        self.image, self.seed = image, seed
+
+class BackgroundLibrary:
+    def __init__(self, root: str, logger=None):
+        self.root, self.logger = root, logger
+        self._arrays, self._lock = {}, threading.Lock()
+
+    def _dir(self, template_id: str, width: int, height: int) -> str:
+        return os.path.join(self.root, template_id, f"{width}x{height}")
+
+    def _open(self, template_id: str, width: int, height: int):
+        key = (template_id, width, height)
+        d = self._dir(template_id, width, height)
+        meta_path = os.path.join(d, "meta.json")
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cached = self._arrays.get(key)
+            if cached is None or cached[0] != mtime:
+                try:
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        meta = json.load(f)
+                    images = np.load(os.path.join(d, "images.npy"), mmap_mode="r")
+                except FileNotFoundError:
+                    return None
+                cached = self._arrays[key] = (mtime, images, meta["seeds"])
+            return cached[1:]
+
+    def pick(self, template_id: str, width: int, height: int, seed: int) -> BackgroundEntry | None:
+        """시드로 라이브러리 항목 하나를 O(1)에 고릅니다. 해당 템플릿/사이즈가 없으면 None."""
+        arrays = self._open(template_id, width, height)
+        if not arrays: return None
+        images, seeds = arrays
+        idx = seed % len(seeds)
+        if self.logger: self.logger.info(f"Using precomputed background {template_id}/{width}x{height}#{idx} (seed {seeds[idx]}).")
+        return BackgroundEntry(Image.fromarray(np.asarray(images[idx])), seeds[idx])
+
+    def write(self, template_id: str, width: int, height: int, images: list[Image.Image], seeds: list[int], background_prompt: str | None = None):
+        d = self._dir(template_id, width, height)
+        os.makedirs(d, exist_ok=True)
+        # 실행 중인 서버가 mmap으로 열고 있을 수 있으므로 임시 파일에 쓴 뒤 교체하고, meta.json을 마지막에 바꿉니다.
+        tmp = os.path.join(d, f"images.{os.getpid()}.tmp.npy")
+        np.save(tmp, np.stack([np.asarray(img.convert("RGB"), dtype=np.uint8) for img in images]))
+        os.replace(tmp, os.path.join(d, "images.npy"))
+        tmp = os.path.join(d, f"meta.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"seeds": list(seeds), "background_prompt": background_prompt}, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(d, "meta.json"))
+        with self._lock:
+            self._arrays.pop((template_id, width, height), None)
+
+def build_library(pipeline, library: BackgroundLibrary, template_ids: list[str], sizes: list[tuple[int, int]], count: int, base_seed: int = 0):
+    import torch
+    pipe = pipeline._load_sdxl_base()
+    for template_id in template_ids:
+        template = pipeline.templates.get(template_id) or {}
+        background_prompt = template.get("background_prompt")
+        if not background_prompt:
+            pipeline.logger.warning(f"Template '{template_id}' has no background_prompt, skipping.")
+            continue
+        for width, height in sizes:
+            # SDXL은 8의 배수 해상도만 받으므로(예: 1350) 그에 맞춰 생성한 뒤 이미지만 요청 크기로 맞춥니다.
+            gen_w, gen_h = width - width % 8, height - height % 8
+            images, seeds = [], []
+            for i in range(count):
+                seed = base_seed + i
+                generator = torch.Generator(device=pipeline.config.DEVICE).manual_seed(seed)
+                image = pipe(prompt=background_prompt, num_inference_steps=25, generator=generator, width=gen_w, height=gen_h).images[0]
+                images.append(image if image.size == (width, height) else image.resize((width, height), Image.LANCZOS))
+                seeds.append(seed)
+            library.write(template_id, width, height, images, seeds, background_prompt)
+            pipeline.logger.info(f"Background library written: {template_id}/{width}x{height} ({count} entries)")
+
+if __name__ == "__main__":
+    import config
+    from logger import setup_logger
+    from pipeline import ImageGenerationPipeline
+
+    parser = argparse.ArgumentParser(description="템플릿/사이즈별 배경 라이브러리를 미리 생성합니다.")
+    parser.add_argument("--templates", nargs="*", default=None, help="템플릿 ID 목록 (기본: templates.json 전체)")
+    parser.add_argument("--sizes", nargs="*", default=["1080x1080", "1080x1350"])
+    parser.add_argument("--count", type=int, default=8, help="템플릿 × 사이즈당 배경 개수")
+    parser.add_argument("--base-seed", type=int, default=0)
+    parser.add_argument("--out", default=getattr(config, "BACKGROUND_LIBRARY_DIR", None) or DEFAULT_LIBRARY_DIR)
+    args = parser.parse_args()
+
+    logger = setup_logger()
+    pipeline = ImageGenerationPipeline(config=config, logger=logger)
+    sizes = [tuple(map(int, s.split("x"))) for s in args.sizes]
+    build_library(pipeline, BackgroundLibrary(args.out, logger), args.templates or list(pipeline.templates.keys()), sizes, args.count, args.base_seed)
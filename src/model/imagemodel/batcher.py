@@ -0,0 +1,54 @@
+# =======================================
+# batcher.py — 이미지 생성 요청 마이크로 배처
+# =======================================
+# 짧은 시간 창(window) 동안 들어온 요청 중 batch_key가 같은 것들
+# (사이즈, 모드, 템플릿)을 모아 pipeline.run_batch 한 번으로 실행하고 결과를 나눠 돌려줍니다.
+# =======================================
+
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+
+class MicroBatcher:
+    def __init__(self, run_batch, key_fn, window_ms: float = 50, max_batch_size: int = 4, logger=None):
+        self.run_batch, self.key_fn, self.logger = run_batch, key_fn, logger
+        self.window, self.max_batch_size = window_ms / 1000, max(1, int(max_batch_size))
+        self._pending = {}
+        # 실행 중인 배치 태스크. 이벤트 루프는 약한 참조만 가지므로 끝날 때까지 여기서 붙잡아 둡니다.
+        self._tasks = set()
+
+    async def submit(self, inputs: dict):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = self.key_fn(inputs)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            loop.call_later(self.window, self._flush, key, batch)
+        batch.append((inputs, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key, batch):
+        # 타이머가 이미 가득 차서 떠난 배치를 가리키면 무시합니다.
+        if self._pending.get(key) is not batch: return
+        del self._pending[key]
+        task = asyncio.get_running_loop().create_task(self._run(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if task.cancelled() or task.exception() is None: return
+        if self.logger: self.logger.error(f"Batch task failed: {task.exception()!r}")
+
+    async def _run(self, key, batch):
+        if self.logger: self.logger.info(f"Running batch of {len(batch)} request(s) for {key}")
+        try:
+            results = await run_in_threadpool(self.run_batch, [inputs for inputs, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done(): continue
+            if isinstance(result, Exception): future.set_exception(result)
+            else: future.set_result(result)
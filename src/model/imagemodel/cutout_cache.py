@@ -0,0 +1,134 @@
+# =======================================
+# cutout_cache.py — rembg 전경 컷아웃 캐시
+# =======================================
+# 이미지 내용 해시로 rembg 결과를 캐시합니다 (메모리 LRU + 디스크 LRU).
+# 컷아웃은 대부분 투명 영역이므로 알파 bbox로 잘라 원본 크기/오프셋과 함께 저장합니다.
+# =======================================
+
+import os
+import io
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image, PngImagePlugin
+
+class CutoutCache:
+    def __init__(self, disk_dir: str | None = None, max_memory_mb: float = 256, max_disk_mb: float = 2048, logger=None):
+        self.disk_dir, self.logger = disk_dir, logger
+        self.max_memory_bytes, self.max_disk_bytes = int(max_memory_mb * 1024**2), int(max_disk_mb * 1024**2)
+        self._memory, self._memory_bytes = OrderedDict(), 0
+        self._lock = threading.Lock()
+        self.memory_hits, self.disk_hits, self.misses = 0, 0, 0
+        self._disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(e.stat().st_size for e in os.scandir(self.disk_dir) if e.name.endswith(".png"))
+
+    @staticmethod
+    def key(image: Image.Image, namespace: str = "") -> str:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{namespace}|{image.mode}|{image.size}".encode())
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def _pack(cutout: Image.Image):
+        cutout = cutout.convert("RGBA")
+        bbox = cutout.getchannel("A").getbbox() or (0, 0, 0, 0)
+        return cutout.crop(bbox), cutout.size, bbox[:2]
+
+    @staticmethod
+    def _unpack(entry) -> Image.Image:
+        cropped, size, offset = entry
+        full = Image.new("RGBA", size, (0, 0, 0, 0))
+        if cropped.width and cropped.height: full.paste(cropped, offset)
+        return full
+
+    @staticmethod
+    def _nbytes(entry) -> int:
+        cropped = entry[0]
+        return cropped.width * cropped.height * 4
+
+    def _remember(self, key, entry):
+        nbytes = self._nbytes(entry)
+        if nbytes > self.max_memory_bytes: return
+        # 같은 이미지를 동시에 처리한 요청이 먼저 넣었을 수 있으므로 기존 항목 크기를 빼고 바꿉니다.
+        old = self._memory.pop(key, None)
+        if old is not None: self._memory_bytes -= self._nbytes(old)
+        self._memory[key] = entry; self._memory_bytes += nbytes
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= self._nbytes(old)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def _load_disk(self, key: str):
+        path = self._disk_path(key)
+        try:
+            with Image.open(path) as img:
+                meta = json.loads(img.text["cutout"])
+                cropped = img.convert("RGBA")
+            os.utime(path)
+            return cropped, tuple(meta["size"]), tuple(meta["offset"])
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            return None
+
+    def _save_disk(self, key: str, entry):
+        cropped, size, offset = entry
+        info = PngImagePlugin.PngInfo()
+        info.add_text("cutout", json.dumps({"size": list(size), "offset": list(offset)}))
+        buf = io.BytesIO()
+        cropped.save(buf, format="PNG", pnginfo=info, compress_level=6)
+        path = self._disk_path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f: f.write(buf.getvalue())
+        with self._lock:
+            try: replaced = os.path.getsize(path)
+            except OSError: replaced = 0
+            os.replace(tmp, path)
+            self._disk_bytes += buf.tell() - replaced
+            if self._disk_bytes > self.max_disk_bytes: self._evict_disk()
+
+    def _evict_disk(self):
+        # 마지막 사용 시각(mtime) 기준으로 가장 오래된 파일부터 지웁니다.
+        files = sorted((e for e in os.scandir(self.disk_dir) if e.name.endswith(".png")), key=lambda e: e.stat().st_mtime)
+        self._disk_bytes = sum(e.stat().st_size for e in files)
+        for e in files:
+            if self._disk_bytes <= self.max_disk_bytes * 0.9: break
+            try:
+                size = e.stat().st_size; os.remove(e.path); self._disk_bytes -= size
+            except FileNotFoundError:
+                pass
+
+    def get_or_compute(self, image: Image.Image, compute, namespace: str = "") -> Image.Image:
+        """캐시된 컷아웃을 돌려주거나 compute(image)로 만든 뒤 저장합니다. 항상 새 RGBA 이미지를 반환합니다."""
+        key = self.key(image, namespace)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key); self.memory_hits += 1
+                return self._unpack(entry)
+        entry = self._load_disk(key) if self.disk_dir else None
+        if entry is not None:
+            with self._lock:
+                self.disk_hits += 1; self._remember(key, entry)
+            return self._unpack(entry)
+
+        entry = self._pack(compute(image))
+        with self._lock:
+            self.misses += 1; self._remember(key, entry)
+        if self.disk_dir:
+            try: self._save_disk(key, entry)
+            except OSError as e:
+                if self.logger: self.logger.warning(f"Could not write cutout cache entry: {e}")
+        return self._unpack(entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "memory_entries": len(self._memory), "memory_mb": round(self._memory_bytes / 1024**2, 1),
+                "disk_mb": round(self._disk_bytes / 1024**2, 1),
+            }
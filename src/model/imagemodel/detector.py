@@ -0,0 +1,72 @@
+# =======================================
+# detector.py — 상주형 Grounding DINO 탐지기
+# =======================================
+# 모델을 ModelManager 캐시에 반정밀도로 상주시키고,
+# 여러 이미지 × 여러 텍스트 쿼리를 한 번의 forward로 처리합니다.
+# =======================================
+
+import torch
+from PIL import Image
+from transformers import GroundingDinoProcessor, AutoModelForZeroShotObjectDetection
+
+HANDS_QUERY = "a person's hands or animal's paws"
+PLACEMENT_QUERY = "the floor or the ground or a table"
+
+class GroundingDinoDetector:
+    def __init__(self, model_manager, config, logger):
+        self.model_manager, self.config, self.logger = model_manager, config, logger
+        on_cuda = torch.cuda.is_available() and str(config.DEVICE).startswith("cuda")
+        self.dtype = torch.float16 if on_cuda else torch.float32
+
+    def _load(self):
+        processor = self.model_manager.load_model("dino_processor", GroundingDinoProcessor, self.config.GROUNDING_DINO_PATH)
+        model = self.model_manager.load_model("dino_model", AutoModelForZeroShotObjectDetection, self.config.GROUNDING_DINO_PATH, torch_dtype=self.dtype)
+        return processor, model
+
+    @staticmethod
+    def _build_text(queries: list[str]) -> tuple[str, list[tuple[int, int]]]:
+        # Grounding DINO 형식: "query one. query two." — 각 쿼리의 문자 구간을 기억해 토큰 구간으로 바꿉니다.
+        text, spans = "", []
+        for q in queries:
+            q = q.strip().rstrip(".").lower()
+            spans.append((len(text), len(text) + len(q)))
+            text += q + ". "
+        return text.strip(), spans
+
+    def detect(self, items: list[tuple[Image.Image, list[str]]], threshold: float = 0.3) -> list[dict[str, list[int] | None]]:
+        """
+        items: [(이미지, [쿼리, ...]), ...]
+        반환: 이미지마다 {쿼리: [x0, y0, x1, y1] 또는 None} — 쿼리별로 가장 점수가 높은 박스
+        """
+        if not items: return []
+        processor, model = self._load()
+        built = [self._build_text(queries) for _, queries in items]
+        texts = [text for text, _ in built]
+
+        inputs = processor(images=[img for img, _ in items], text=texts, padding="longest", return_tensors="pt").to(self.config.DEVICE)
+        inputs["pixel_values"] = inputs["pixel_values"].to(self.dtype)
+        with torch.no_grad():
+            outputs = model(**inputs)
+
+        probs = outputs.logits.float().sigmoid()
+        pred_boxes = outputs.pred_boxes.float()
+        offsets = processor.tokenizer(texts, padding="longest", return_offsets_mapping=True)["offset_mapping"]
+
+        results = []
+        for b, ((image, queries), (_, spans)) in enumerate(zip(items, built)):
+            w, h = image.size
+            found = {}
+            for q, (start, end) in zip(queries, spans):
+                token_idx = [i for i, (s, e) in enumerate(offsets[b]) if e > s and s >= start and e <= end]
+                if not token_idx:
+                    found[q] = None; continue
+                scores = probs[b][:, token_idx].max(dim=-1).values
+                best = int(scores.argmax())
+                if float(scores[best]) < threshold:
+                    self.logger.warning(f"No suitable area for '{q}' found by Grounding DINO.")
+                    found[q] = None; continue
+                cx, cy, bw, bh = pred_boxes[b][best].tolist()
+                found[q] = [int((cx - bw / 2) * w), int((cy - bh / 2) * h), int((cx + bw / 2) * w), int((cy + bh / 2) * h)]
+                self.logger.info(f"'{q}' area found at coordinates: {found[q]}")
+            results.append(found)
+        return results
@@ -0,0 +1,133 @@
+# =======================================
+# jobs.py — 비동기 이미지 생성 작업 큐 (submit / poll / fetch)
+# =======================================
+# POST /jobs 는 작업 ID만 즉시 돌려주고, 프로세스 내 큐와 워커가 실제 생성을 수행합니다.
+# 완료된 결과는 보존 시간/개수 한도 안에서만 보관합니다.
+# 파이프라인 진행 이벤트(단계/스텝/미리보기)는 작업별로 쌓여 SSE로 전달됩니다.
+# =======================================
+
+import time
+import uuid
+import asyncio
+import traceback
+from collections import OrderedDict
+
+class QueueFullError(Exception):
+    pass
+
+MAX_EVENTS_PER_JOB = 1000
+TERMINAL_EVENTS = ("done", "failed", "cancelled")
+
+class Job:
+    def __init__(self, inputs: dict):
+        self.id = uuid.uuid4().hex
+        self.inputs = inputs
+        self.status = "queued"
+        self.result, self.error = None, None
+        self.created_at, self.started_at, self.finished_at = time.time(), None, None
+        self.cancelled = False
+        self.events = []
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+    def _push(self, event: dict):
+        if len(self.events) >= MAX_EVENTS_PER_JOB and event.get("type") == "step": return
+        self.events.append({**event, "time": time.time()})
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def emit(self, event: dict):
+        """파이프라인 워커 스레드에서 호출됩니다."""
+        self._loop.call_soon_threadsafe(self._push, event)
+
+    async def wait_events(self, index: int, timeout: float = 15) -> list[dict]:
+        """index 이후의 이벤트를 돌려줍니다. 아직 없으면 새 이벤트나 timeout까지 기다립니다."""
+        if len(self.events) <= index and self.finished_at is None:
+            try: await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError: pass
+        return self.events[index:]
+
+    def to_dict(self, include_result: bool = True) -> dict:
+        data = {
+            "job_id": self.id, "status": self.status,
+            "created_at": self.created_at, "started_at": self.started_at, "finished_at": self.finished_at,
+        }
+        if self.status == "succeeded" and include_result: data["result"] = self.result
+        if self.status == "failed": data["error"] = self.error
+        return data
+
+class JobManager:
+    def __init__(self, run_fn, workers: int = 1, max_queue: int = 100, retention_seconds: float = 3600, max_retained: int = 500, logger=None):
+        self.run_fn, self.logger = run_fn, logger
+        self.num_workers, self.max_queue = max(1, int(workers)), int(max_queue)
+        self.retention_seconds, self.max_retained = retention_seconds, int(max_retained)
+        self.jobs = OrderedDict()
+        self._queue, self._workers = None, []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._workers = [asyncio.get_running_loop().create_task(self._worker()) for _ in range(self.num_workers)]
+
+    async def stop(self):
+        for w in self._workers: w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, inputs: dict) -> Job:
+        self._prune()
+        job = Job(inputs)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Job queue is full ({self.max_queue})")
+        self.jobs[job.id] = job
+        if self.logger: self.logger.info(f"Job {job.id} queued (queue size {self._queue.qsize()}).")
+        return job
+
+    def cancel(self, job_id: str) -> Job | None:
+        job = self.get(job_id)
+        if job is not None and job.finished_at is None:
+            job.cancelled = True
+            job._push({"type": "stage", "stage": "cancelling"})
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        self._prune()
+        return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        counts = {}
+        for job in self.jobs.values(): counts[job.status] = counts.get(job.status, 0) + 1
+        return {"queue_size": self._queue.qsize() if self._queue else 0, "jobs": counts}
+
+    def _prune(self):
+        now = time.time()
+        finished = [j for j in self.jobs.values() if j.finished_at is not None]
+        overflow = len(self.jobs) - self.max_retained
+        for job in finished:
+            if now - job.finished_at > self.retention_seconds or overflow > 0:
+                del self.jobs[job.id]; overflow -= 1
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.cancelled:
+                job.status, job.finished_at, job.inputs = "cancelled", time.time(), None
+                job._push({"type": "cancelled"})
+                self._queue.task_done()
+                continue
+            job.status, job.started_at = "running", time.time()
+            try:
+                job.result = await self.run_fn({**job.inputs, "on_event": job.emit, "is_cancelled": lambda job=job: job.cancelled})
+                job.status = "succeeded"
+            except Exception as e:
+                if job.cancelled:
+                    job.status = "cancelled"
+                else:
+                    if self.logger: self.logger.error(f"Job {job.id} failed: {e}\n{traceback.format_exc()}")
+                    job.status, job.error = "failed", "이미지 생성 중 내부 서버 오류 발생"
+            finally:
+                job.finished_at = time.time()
+                job.inputs = None
+                job._push({"type": job.status if job.status != "succeeded" else "done", "status": job.status})
+                self._queue.task_done()
@@ -0,0 +1,64 @@
+# =======================================
+# llm_cache.py — LLM 응답 영속 캐시 (SQLite)
+# =======================================
+# 같은 제품/모델 이미지에 대한 분류 호출(카테고리, 모델 타입)이 반복되므로
+# (함수, 모델, 프롬프트, 이미지 내용) 해시를 키로 해석된 응답을 보관합니다.
+# 항목은 TTL이 지나면 무효이고, 항목 수가 한도를 넘으면 마지막 사용 시각이 오래된 것부터 지웁니다.
+# =======================================
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+class LLMCache:
+    def __init__(self, path: str, ttl_seconds: float = 7 * 24 * 3600, max_entries: int = 10000, logger=None):
+        self.path, self.logger = path, logger
+        self.ttl_seconds, self.max_entries = ttl_seconds, int(max_entries)
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, fn TEXT, value TEXT, created_at REAL, last_used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+
+    @staticmethod
+    def key(fn: str, request: dict) -> str:
+        """요청 kwargs 전체(모델, 메시지 텍스트, base64 이미지)를 정규화해 해시합니다. timeout처럼 응답과 무관한 값은 뺍니다."""
+        canonical = {k: v for k, v in request.items() if k != "timeout"}
+        h = hashlib.blake2b(digest_size=20)
+        h.update(fn.encode())
+        h.update(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode())
+        return h.hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl_seconds and now - row[1] > self.ttl_seconds):
+                if row is not None: self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, fn: str, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)", (key, fn, json.dumps(value, ensure_ascii=False), now, now))
+            count = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if count > self.max_entries:
+                # 한도의 90%까지 줄여 매 삽입마다 지우지 않게 합니다. 만료 항목을 먼저 지웁니다.
+                if self.ttl_seconds: self._db.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+                excess = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - int(self.max_entries * 0.9)
+                if excess > 0:
+                    self._db.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)", (excess,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
@@ -0,0 +1,196 @@
+# =======================================
+# output_store.py — 실행별 출력 디렉토리 저장소 + 보존 정책(GC)
+# =======================================
+# 디렉토리 구조: {root}/{YYYY-MM-DD}/{HHMMSS}-{uuid8}/
+# 실행 ID는 시각 + uuid로 만들어 디렉토리를 훑지 않고(O(1)) 동시 요청에서도 겹치지 않습니다.
+# 백그라운드 스레드가 주기적으로 오래된 실행(OUTPUT_RETENTION_DAYS)과
+# 총 용량 초과분(OUTPUT_MAX_TOTAL_GB, 오래된 실행부터)을 지웁니다.
+# 디버그 산출물(00_*, 01_*)은 artifact_level(none / key / all)에 따라 고르고,
+# 별도 writer 스레드가 제한된 큐에서 꺼내 인코딩/저장합니다 (가득 차면 버림).
+# =======================================
+
+import os
+import io
+import time
+import uuid
+import base64
+import shutil
+import logging
+import queue
+import threading
+from datetime import datetime, timedelta
+from PIL import Image
+
+# output_format → (PIL 포맷, 확장자, MIME 타입)
+IMAGE_FORMATS = {
+    "png": ("PNG", "png", "image/png"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+DEFAULT_QUALITY = 90
+
+def encode_image(image: Image.Image, fmt: str = "png", quality: int | None = None) -> bytes:
+    """이미지를 지정한 포맷의 바이트로 인코딩합니다. quality는 WebP/JPEG에만 적용됩니다."""
+    pil_format = IMAGE_FORMATS[fmt][0]
+    buf = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buf, format="PNG")
+    elif pil_format == "WEBP":
+        image.save(buf, format="WEBP", quality=quality or DEFAULT_QUALITY, method=4)
+    else:
+        image.convert("RGB").save(buf, format="JPEG", quality=quality or DEFAULT_QUALITY)
+    return buf.getvalue()
+
+ARTIFACT_LEVELS = ("none", "key", "all")
+
+class ArtifactWriter:
+    def __init__(self, max_pending: int = 32, logger=None):
+        self.logger = logger
+        self._queue = queue.Queue(maxsize=max(1, int(max_pending)))
+        self.written, self.dropped = 0, 0
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None: return
+        self._thread = threading.Thread(target=self._loop, name="artifact-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, output_manager: "OutputManager", image: Image.Image, base_filename: str) -> bool:
+        try:
+            self._queue.put_nowait((output_manager, image, base_filename))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.logger: self.logger.warning(f"Artifact writer queue is full, dropping {base_filename}.")
+            return False
+
+    def _loop(self):
+        while True:
+            output_manager, image, base_filename = self._queue.get()
+            try:
+                output_manager.save(image, base_filename); self.written += 1
+            except Exception as e:
+                if self.logger: self.logger.warning(f"Could not write artifact {base_filename}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {"pending": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+class OutputManager:
+    def __init__(self, output_dir="outputs", logger=None, artifact_level: str = "all", writer: ArtifactWriter | None = None):
+        self.output_dir, self.logger = output_dir, logger or logging.getLogger("AdImagePipeline")
+        self.artifact_level, self.writer = artifact_level, writer
+    def wants_artifact(self, level: str = "key") -> bool:
+        return ARTIFACT_LEVELS.index(self.artifact_level) >= ARTIFACT_LEVELS.index(level)
+    def artifact(self, image: Image.Image, base_filename: str, level: str = "key"):
+        """디버그 산출물 저장. artifact_level이 level보다 낮으면 건너뛰고, writer가 있으면 백그라운드로 넘깁니다."""
+        if not self.wants_artifact(level): return
+        if self.writer is not None: self.writer.submit(self, image, base_filename)
+        else: self.save(image, base_filename)
+    def save(self, image: Image.Image, base_filename: str, fmt: str = "png", quality: int | None = None) -> str:
+        return self.write_bytes(encode_image(image, fmt, quality), base_filename, fmt)
+    def write_bytes(self, data: bytes, base_filename: str, fmt: str = "png") -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{base_filename}.{IMAGE_FORMATS[fmt][1]}")
+        with open(path, "wb") as f: f.write(data)
+        if self.logger: self.logger.info(f"Image saved to {path}")
+        return path
+    def to_base64(self, image: Image.Image, fmt: str = "png", quality: int | None = None) -> str:
+        return base64.b64encode(encode_image(image, fmt, quality)).decode("utf-8")
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try: total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError: pass
+    return total
+
+class OutputStore:
+    def __init__(self, root: str = "outputs", retention_days: float | None = 7, max_total_gb: float | None = 20, gc_interval_seconds: float = 600, artifact_level: str = "key", writer_queue_size: int = 32, logger=None):
+        self.root, self.logger = root, logger
+        self.retention_days = retention_days or None
+        self.max_total_bytes = int(max_total_gb * 1024**3) if max_total_gb else None
+        self.gc_interval = gc_interval_seconds
+        if artifact_level not in ARTIFACT_LEVELS: raise ValueError(f"artifact_level must be one of {ARTIFACT_LEVELS}")
+        self.artifact_level = artifact_level
+        self.writer = ArtifactWriter(writer_queue_size, logger)
+        self.removed_runs, self.last_gc_at = 0, None
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def new_run(self, artifact_level: str | None = None) -> OutputManager:
+        """새 실행 디렉토리를 배정합니다. 디렉토리는 실제로 파일을 쓸 때 만들어집니다."""
+        now = datetime.now()
+        run_id = f"{now:%H%M%S}-{uuid.uuid4().hex[:8]}"
+        run_dir = os.path.join(self.root, f"{now:%Y-%m-%d}", run_id)
+        if self.logger: self.logger.info(f"Output for this run will be saved to: {run_dir}")
+        return OutputManager(output_dir=run_dir, logger=self.logger, artifact_level=artifact_level or self.artifact_level, writer=self.writer)
+
+    def _shards(self) -> list[tuple[datetime, str]]:
+        shards = []
+        for e in os.scandir(self.root):
+            if not e.is_dir(): continue
+            try: shards.append((datetime.strptime(e.name, "%Y-%m-%d"), e.path))
+            except ValueError: continue  # 날짜 샤드가 아닌 디렉토리(예: 이전 형식의 숫자 ID)는 건드리지 않습니다.
+        return sorted(shards)
+
+    def _remove(self, path: str):
+        shutil.rmtree(path, ignore_errors=True)
+
+    def collect(self) -> int:
+        """보존 기간/총 용량 정책에 따라 오래된 실행 디렉토리를 지우고, 지운 실행 수를 반환합니다."""
+        removed = 0
+        shards = self._shards()
+        if self.retention_days:
+            cutoff = datetime.now() - timedelta(days=self.retention_days)
+            keep = []
+            for day, path in shards:
+                # 날짜 샤드 전체가 기한을 넘었으면 통째로 지웁니다.
+                if day + timedelta(days=1) <= cutoff:
+                    removed += sum(1 for e in os.scandir(path) if e.is_dir())
+                    self._remove(path)
+                else:
+                    keep.append((day, path))
+            shards = keep
+
+        if self.max_total_bytes:
+            runs = []
+            for _, path in shards:
+                runs.extend(sorted((e.name, e.path) for e in os.scandir(path) if e.is_dir()))
+            sizes = [(p, _dir_bytes(p)) for _, p in runs]
+            total = sum(size for _, size in sizes)
+            for path, size in sizes:
+                if total <= self.max_total_bytes: break
+                self._remove(path); total -= size; removed += 1
+            today = datetime.now().strftime("%Y-%m-%d")
+            for _, path in shards:
+                if os.path.basename(path) == today: continue  # new_run()과 경합하지 않도록 오늘 샤드는 남깁니다.
+                try: os.rmdir(path)  # 비어 있는 날짜 샤드만 지워집니다.
+                except OSError: pass
+
+        self.removed_runs += removed
+        self.last_gc_at = time.time()
+        if removed and self.logger: self.logger.info(f"Output GC removed {removed} run(s) from {self.root}.")
+        return removed
+
+    def _gc_loop(self):
+        while True:
+            try: self.collect()
+            except Exception as e:
+                if self.logger: self.logger.warning(f"Output GC failed: {e}")
+            if self._stop.wait(self.gc_interval): break
+
+    def start(self):
+        self.writer.start()
+        if self._thread is not None or not (self.retention_days or self.max_total_bytes): return
+        self._thread = threading.Thread(target=self._gc_loop, name="output-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        return {"root": self.root, "removed_runs": self.removed_runs, "last_gc_at": self.last_gc_at, "artifact_level": self.artifact_level, "artifact_writer": self.writer.stats()}
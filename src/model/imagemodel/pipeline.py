@@ -7,8 +7,12 @@
 import os
 import io
 import base64
-import logging
+import re
 import json
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 import torch
 import torch.nn.functional as F
 import numpy as np
@@ -18,79 +22,319 @@ from PIL import Image
 from rembg import remove
 
 import config
-from transformers import CLIPVisionModelWithProjection, GroundingDinoProcessor, AutoModelForZeroShotObjectDetection
+from transformers import CLIPVisionModelWithProjection
 from diffusers import (
     StableDiffusionXLPipeline,
     StableDiffusionXLControlNetPipeline, 
     StableDiffusionXLImg2ImgPipeline,
     ControlNetModel,
-    AutoencoderKL
+    AutoencoderKL,
+    EulerDiscreteScheduler,
+    EulerAncestralDiscreteScheduler,
+    DPMSolverMultistepScheduler,
+    UniPCMultistepScheduler,
+    LCMScheduler,
 )
-from prompt_utils import encode_prompt_sdxl, build_ad_prompt_compose, get_relative_scale_from_llm, _get_product_category_from_llm
-
-def _clip_text_embed(pipe, text: str):
+from prompt_utils import encode_prompt_sdxl, text_encoder_2_embeds, precompute_prompt_embeds, build_ad_prompt_compose, get_relative_scale_from_llm, _get_product_category_from_llm, prepare_llm_image
+from detector import GroundingDinoDetector, HANDS_QUERY, PLACEMENT_QUERY
+from background_library import BackgroundLibrary, DEFAULT_LIBRARY_DIR
+from cutout_cache import CutoutCache
+from output_store import OutputStore, IMAGE_FORMATS, encode_image
+from result_cache import ResultCache, fingerprint
+from stage_scheduler import StageScheduler
+from rembg_sessions import RembgSessionPool
+from stage_metrics import StageTimings, stage, recording
+
+_ACTION_REFS = ["subject physically holding the product", "clear hand or paw gripping the item", "tactile interaction"]
+_STATIC_REFS = ["static studio product photo", "product centered, model nearby but not touching"]
+# 로드된 텍스트 인코더마다 기준 문장 centroid를 한 번만 계산해 둡니다. (인코더가 내려가면 함께 사라짐)
+_INTENT_CENTROIDS = weakref.WeakKeyDictionary()
+
+def _text_encoder(pipe):
     te = getattr(pipe, "text_encoder_2", None) or getattr(pipe, "text_encoder", None)
     tok = getattr(pipe, "tokenizer_2", None) or getattr(pipe, "tokenizer", None)
     if te is None or tok is None: raise RuntimeError("No text encoder/tokenizer on pipeline")
-    inputs = tok(text, return_tensors="pt", padding=True, truncation=True, max_length=tok.model_max_length).to(pipe.device)
+    return te, tok
+
+def _clip_text_embed(pipe, texts: str | list[str]):
+    """텍스트(들)를 한 번의 배치로 인코딩해 정규화된 (N, D) 임베딩을 반환합니다."""
+    te, tok = _text_encoder(pipe)
+    texts = [texts] if isinstance(texts, str) else list(texts)
+    inputs = tok(texts, return_tensors="pt", padding=True, truncation=True, max_length=tok.model_max_length).to(pipe.device)
     with torch.no_grad():
         out = te(**inputs, output_hidden_states=True)
         pooled = out[0]
     return F.normalize(pooled, dim=-1)
 
+def _intent_centroids(pipe):
+    te, _ = _text_encoder(pipe)
+    centroids = _INTENT_CENTROIDS.get(te)
+    if centroids is None:
+        refs = _clip_text_embed(pipe, _ACTION_REFS + _STATIC_REFS)
+        act = F.normalize(refs[:len(_ACTION_REFS)].mean(dim=0, keepdim=True), dim=-1)
+        sta = F.normalize(refs[len(_ACTION_REFS):].mean(dim=0, keepdim=True), dim=-1)
+        centroids = _INTENT_CENTROIDS[te] = torch.cat([act, sta], dim=0)
+    return centroids
+
+def _intent_action_scores(pipe, user_texts: list[str]) -> list[float]:
+    if not user_texts: return []
+    sims = (_clip_text_embed(pipe, user_texts) @ _intent_centroids(pipe).T).float().cpu()
+    return [max(0.0, min(1.0, (float(s_act) - float(s_sta)) * 0.5 + 0.5)) for s_act, s_sta in sims.tolist()]
+
 def _intent_action_score(pipe, user_text: str) -> float:
-    act_refs = ["subject physically holding the product", "clear hand or paw gripping the item", "tactile interaction"]
-    static_refs = ["static studio product photo", "product centered, model nearby but not touching"]
-    q = _clip_text_embed(pipe, user_text)
-    act = F.normalize(torch.stack([_clip_text_embed(pipe, t).squeeze(0) for t in act_refs], dim=0).mean(dim=0, keepdim=True), dim=-1)
-    sta = F.normalize(torch.stack([_clip_text_embed(pipe, t).squeeze(0) for t in static_refs], dim=0).mean(dim=0, keepdim=True), dim=-1)
-    s_act, s_sta = float((q @ act.T).squeeze()), float((q @ sta.T).squeeze())
-    return max(0.0, min(1.0, (s_act - s_sta) * 0.5 + 0.5))
-
-class OutputManager:
-    def __init__(self, output_dir="outputs", logger=None):
-        self.output_dir, self.logger = output_dir, logger or logging.getLogger("AdImagePipeline")
-        os.makedirs(self.output_dir, exist_ok=True)
-    def save(self, image: Image.Image, base_filename: str) -> str:
-        path = os.path.join(self.output_dir, f"{base_filename}.png")
-        image.save(path)
-        if self.logger: self.logger.info(f"Image saved to {path}")
-        return path
-    def to_base64(self, image: Image.Image) -> str:
-        buf = io.BytesIO()
-        image.save(buf, format="PNG"); return base64.b64encode(buf.getvalue()).decode("utf-8")
+    return _intent_action_scores(pipe, [user_text])[0]
+
+# SDXL 잠재 공간 → RGB 선형 근사 계수 (VAE 디코드 없이 미리보기용)
+_SDXL_LATENT_RGB = [[0.3651, 0.4232, 0.4341], [-0.2533, -0.0042, 0.1068], [0.1076, 0.1111, -0.0362], [-0.3165, -0.2492, -0.6353]]
+_SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+def _latent_preview(latents) -> str:
+    """(4, h, w) 잠재값을 1/8 해상도 JPEG base64 미리보기로 만듭니다."""
+    factors = torch.tensor(_SDXL_LATENT_RGB, device=latents.device, dtype=torch.float32)
+    bias = torch.tensor(_SDXL_LATENT_RGB_BIAS, device=latents.device, dtype=torch.float32)
+    rgb = torch.einsum("chw,cr->hwr", latents.float(), factors) + bias
+    arr = ((rgb.clamp(-1, 1) + 1) * 127.5).to(torch.uint8).cpu().numpy()
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format="JPEG", quality=70)
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+# 스케줄러 이름 → (클래스, from_config 추가 인자)
+SCHEDULERS = {
+    "euler": (EulerDiscreteScheduler, {}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "dpmpp_2m": (DPMSolverMultistepScheduler, {}),
+    "dpmpp_2m_karras": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True}),
+    "dpmpp_2m_sde_karras": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True, "algorithm_type": "sde-dpmsolver++"}),
+    "unipc": (UniPCMultistepScheduler, {}),
+    "lcm": (LCMScheduler, {}),
+}
+
+# params.quality 티어별 생성 설정. (config.QUALITY_PROFILES[티어]로 항목별 덮어쓰기 가능)
+# scheduler=None이면 모델 기본 스케줄러를 씁니다. lora.path_config에 적힌 config 키에 few-step 증류 LoRA
+# 로컬 경로가 있으면, lora의 나머지 값(스케줄러/스텝/가이던스)이 티어 기본값을 대신합니다.
+# guidance_scale은 1보다 커야 합니다 (배치 IP-Adapter 임베딩이 CFG 전제).
+QUALITY_PROFILES = {
+    "draft": {
+        "scheduler": "dpmpp_2m_karras", "background_steps": 12, "base_steps": 16, "guidance_scale": 5.0, "refiner": False, "refiner_steps": 0,
+        "lora": {"path_config": "DRAFT_LORA_PATH", "scheduler": "lcm", "background_steps": 4, "base_steps": 6, "guidance_scale": 1.5},
+    },
+    "standard": {"scheduler": "dpmpp_2m_karras", "background_steps": 20, "base_steps": 25, "guidance_scale": 5.0, "refiner": True, "refiner_steps": 25},
+    "premium": {"scheduler": None, "background_steps": 25, "base_steps": 40, "guidance_scale": 5.0, "refiner": True, "refiner_steps": 40},
+}
+
+def _tensors(*models):
+    for model in models:
+        modules = [model] if isinstance(model, torch.nn.Module) else [m for m in getattr(model, "components", {}).values() if isinstance(m, torch.nn.Module)]
+        for m in modules:
+            yield from m.parameters()
+            yield from m.buffers()
+
+def _module_bytes(*models, exclude=None) -> int:
+    """모델(또는 diffusers 파이프라인)들이 차지하는 메모리를 바이트 단위로 추정합니다. 공유 텐서는 한 번만 셉니다."""
+    seen, total = set(exclude or ()), 0
+    for t in _tensors(*models):
+        if t.data_ptr() in seen: continue
+        seen.add(t.data_ptr()); total += t.numel() * t.element_size()
+    return total
 
 class ModelManager:
+    """
+    최근 사용 순서(LRU)로 모델을 상주시키는 캐시이자 SDXL 컴포넌트 레지스트리입니다.
+    MODEL_CACHE_BUDGET_GB 예산을 넘으면 가장 오래 쓰지 않은 모델부터 내립니다.
+    (미설정 시 CUDA 장치 메모리의 85%, 0이면 상주 없이 매번 로드)
+    depends_on으로 다른 모델의 가중치를 공유하는 항목을 등록하면, 부모가 내려갈 때 함께 내려갑니다.
+    pinned()로 고정한 항목(과 그 부모)은 블록이 끝날 때까지 예산을 넘더라도 내리지 않습니다.
+    """
     def __init__(self, config, logger):
-        self.config, self.logger, self.loaded_models = config, logger, {}
-
-    def load_model(self, key, model_class, model_path, **kwargs):
-        if key in self.loaded_models: return self.loaded_models[key]
-        self.logger.info(f"Loading model '{key}' from {model_path}...")
-        
-        use_fp16 = kwargs.pop('use_fp16_variant', False)
-        pretrained_kwargs = {"torch_dtype": self.config.TORCH_DTYPE, "use_safetensors": True, **kwargs}
-        if use_fp16: pretrained_kwargs["variant"] = "fp16"
-        
-        model = model_class.from_pretrained(model_path, **pretrained_kwargs)
-
-        if hasattr(model, "to"):
-            model.to(self.config.DEVICE)
-            
+        self.config, self.logger = config, logger
+        self.loaded_models, self.model_sizes, self.dependencies = OrderedDict(), {}, {}
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self._lock = threading.RLock()
+        self._pinned = {}  # key → 고정 횟수
+
+        budget_gb = getattr(config, "MODEL_CACHE_BUDGET_GB", None)
+        if budget_gb is not None:
+            self.budget_bytes = int(float(budget_gb) * 1024**3)
+        elif torch.cuda.is_available() and str(config.DEVICE).startswith("cuda"):
+            self.budget_bytes = int(torch.cuda.get_device_properties(torch.device(config.DEVICE)).total_memory * 0.85)
+        else:
+            self.budget_bytes = None
+        self.logger.info(f"Model cache budget: {'unlimited' if self.budget_bytes is None else f'{self.budget_bytes / 1024**3:.1f} GB'}")
+
+    def _lookup(self, key):
+        if key in self.loaded_models:
+            self.hits += 1
+            self.loaded_models.move_to_end(key)
+            for parent in self._ancestors(key): self.loaded_models.move_to_end(parent)
+            return self.loaded_models[key]
+        self.misses += 1
+        return None
+
+    def _register(self, key, model, depends_on):
+        self.dependencies[key] = tuple(depends_on)
         self.loaded_models[key] = model
-        return model
 
-    def unload(self, *keys):
-        keys_to_unload = keys or list(self.loaded_models.keys())
-        for k in keys_to_unload:
+    def load_model(self, key, model_class, model_path, depends_on=(), **kwargs):
+        with self._lock:
+            model = self._lookup(key)
+            if model is not None: return model
+            keep = {key, *self._ancestors(key, depends_on)}
+            # 이전에 로드한 적 있는 모델이면 크기를 알고 있으므로 미리 자리를 비웁니다.
+            self._evict_to_fit(self.model_sizes.get(key, 0), keep=keep)
+            self.logger.info(f"Loading model '{key}' from {model_path}...")
+
+            use_fp16 = kwargs.pop('use_fp16_variant', False)
+            pretrained_kwargs = {"torch_dtype": self.config.TORCH_DTYPE, "use_safetensors": True, **kwargs}
+            if use_fp16: pretrained_kwargs["variant"] = "fp16"
+
+            model = model_class.from_pretrained(model_path, **pretrained_kwargs)
+            # 장치로 올리기 전에 (이미 상주 중인 공유 가중치를 뺀) 크기를 재고 자리를 비워
+            # 첫 로드에서도 예산을 넘지 않게 합니다.
+            self.model_sizes[key] = _module_bytes(model, exclude=self._resident_ptrs())
+            self._evict_to_fit(self.model_sizes[key], keep=keep)
+
+            if hasattr(model, "to"):
+                model.to(self.config.DEVICE)
+
+            self._register(key, model, depends_on)
+            return model
+
+    @contextmanager
+    def pinned(self, *keys):
+        """
+        한 단계 안에서 추가 로드(ControlNet, IP-Adapter 이미지 인코더 등)가 지금 쓰고 있는 모델을 밀어내지 않게 합니다.
+        밀려난 모델은 지역 참조로 살아 있어 실제 VRAM은 그대로인데 캐시만 비었다고 보게 되기 때문입니다.
+        """
+        with self._lock:
+            for k in keys: self._pinned[k] = self._pinned.get(k, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for k in keys:
+                    self._pinned[k] -= 1
+                    if not self._pinned[k]: del self._pinned[k]
+
+    def derive_pipeline(self, key, pipe_class, base_key, depends_on=(), **components):
+        """
+        base_key 파이프라인의 UNet/VAE/텍스트 인코더를 그대로 공유하는 변형 파이프라인을
+        from_pipe로 만들어 캐시합니다. 추가 가중치는 components로 넘긴 모델뿐입니다.
+        """
+        with self._lock:
+            pipe = self._lookup(key)
+            if pipe is not None: return pipe
+            if base_key not in self.loaded_models: raise KeyError(f"Base pipeline '{base_key}' is not loaded")
+            self.logger.info(f"Building pipeline '{key}' from shared components of '{base_key}'...")
+            pipe = pipe_class.from_pipe(self.loaded_models[base_key], **components)
+            self.model_sizes[key] = 0
+            self._register(key, pipe, (base_key, *depends_on))
+            return pipe
+
+    def _ancestors(self, key, depends_on=None):
+        stack, found = list(self.dependencies.get(key, ()) if depends_on is None else depends_on), []
+        while stack:
+            k = stack.pop()
+            if k in found: continue
+            found.append(k); stack.extend(self.dependencies.get(k, ()))
+        return found
+
+    def _dependents(self, key):
+        return [k for k in self.loaded_models if key in self._ancestors(k)]
+
+    def _resident_ptrs(self):
+        return {t.data_ptr() for t in _tensors(*self.loaded_models.values())}
+
+    def resident_bytes(self) -> int:
+        return _module_bytes(*self.loaded_models.values())
+
+    def _drop(self, key, reason):
+        for k in self._dependents(key):
             if k in self.loaded_models:
                 del self.loaded_models[k]
-                self.logger.info(f"Model '{k}' unloaded.")
+                self.logger.info(f"Model '{k}' {reason} (shares weights with '{key}').")
+        del self.loaded_models[key]
+        self.logger.info(f"Model '{key}' {reason}.")
+
+    def _evict_to_fit(self, incoming_bytes: int, keep=()):
+        if self.budget_bytes is None: return
+        keep = {*keep, *self._pinned}
+        keep.update(a for k in list(keep) for a in self._ancestors(k))
+        evicted = False
+        for k in list(self.loaded_models.keys()):
+            if self.resident_bytes() + incoming_bytes <= self.budget_bytes: break
+            if k in keep or k not in self.loaded_models: continue
+            if any(d in keep for d in self._dependents(k)): continue
+            self._drop(k, f"evicted (LRU, budget {self.budget_bytes / 1024**3:.1f} GB)")
+            self.evictions += 1; evicted = True
+        if evicted and torch.cuda.is_available(): torch.cuda.empty_cache()
+
+    def trim(self):
+        """요청이 끝난 뒤 호출합니다. 예산 안의 모델은 다음 요청을 위해 상주시킵니다."""
+        with self._lock:
+            if self.budget_bytes == 0: self.unload()
+            else: self._evict_to_fit(0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "resident": list(self.loaded_models.keys()),
+                "resident_gb": round(self.resident_bytes() / 1024**3, 2),
+                "budget_gb": None if self.budget_bytes is None else round(self.budget_bytes / 1024**3, 2),
+            }
+
+    def unload(self, *keys):
+        with self._lock:
+            keys_to_unload = keys or list(self.loaded_models.keys())
+            for k in keys_to_unload:
+                if k in self.loaded_models:
+                    self._drop(k, "unloaded")
+
+class GenerationJob:
+    """run()/run_batch()에서 요청 한 건의 상태. 준비 → base 생성 → 리파인 → 마무리 단계를 거치며 채워집니다."""
+    def __init__(self, inputs: dict):
+        if inputs.get("params") is None: inputs["params"] = {}
+        self.inputs, self.params = inputs, inputs["params"]
+        # 진행 이벤트 수신/취소 확인용 콜백 (jobs.py에서 주입, API 입력에는 없음)
+        self.on_event, self.is_cancelled = inputs.pop("on_event", None), inputs.pop("is_cancelled", None)
+        self.output_manager = None
+        self.product_image = self.model_image = None
+        self.width = self.height = self.seed = self.generator = None
+        self.mode, self.template_id = None, None
+        self.ad_prompt, self.prompt_embeds = None, None
+        self.condition_image = self.canny_image = None
+        self.controlnet_scale = self.ip_adapter_scale = None
+        self.base_latents, self.final_image = None, None
+        self.profile, self.denoising_split = None, None
+        self.llm_images = {}
+        self.cache_key = None
+        self.timings = StageTimings()
+
+    def emit(self, event_type: str, **data):
+        if self.on_event is None: return
+        try: self.on_event({"type": event_type, **data})
+        except Exception: pass
+
+    @property
+    def cancelled(self) -> bool:
+        return bool(self.is_cancelled and self.is_cancelled())
+
+class GenerationCancelled(Exception):
+    pass
+
+class InputImageError(ValueError):
+    """업로드 이미지가 디코드할 수 없거나 크기 한도를 넘을 때."""
+    pass
 
 class ImageGenerationPipeline:
     def __init__(self, config, logger):
         self.config, self.logger = config, logger
         self.model_manager = ModelManager(config, logger)
+        self.stages = StageScheduler(getattr(config, "CPU_STAGE_WORKERS", 4), getattr(config, "IO_STAGE_WORKERS", 8), logger)
+        self.detector = GroundingDinoDetector(self.model_manager, config, logger)
+        self.background_library = BackgroundLibrary(getattr(config, "BACKGROUND_LIBRARY_DIR", None) or DEFAULT_LIBRARY_DIR, logger)
         
         self.negative_prompt = (
             "ugly, deformed, noisy, blurry, low resolution, bad anatomy, "
@@ -103,14 +347,28 @@ class ImageGenerationPipeline:
         )
         
         try:
-            if hasattr(config, 'REMBG_MODEL_PATH') and config.REMBG_MODEL_PATH:
-                import onnxruntime
-                self.rembg_session = onnxruntime.InferenceSession(config.REMBG_MODEL_PATH, providers=['CPUExecutionProvider'])
-            else:
-                self.rembg_session = None
+            self.rembg_sessions = RembgSessionPool(config, logger)
         except Exception as e:
-            self.logger.warning(f"Could not load rembg onnx session, will use default session: {e}")
-            self.rembg_session = None
+            self.logger.warning(f"Could not create rembg session pool, will use default session: {e}")
+            self.rembg_sessions = None
+
+        self.cutout_cache = CutoutCache(
+            disk_dir=getattr(config, "CUTOUT_CACHE_DIR", os.path.join("cache", "cutouts")),
+            max_memory_mb=getattr(config, "CUTOUT_CACHE_MEMORY_MB", 256),
+            max_disk_mb=getattr(config, "CUTOUT_CACHE_DISK_MB", 2048),
+            logger=logger,
+        )
+
+        self.output_store = OutputStore(
+            root=getattr(config, "OUTPUT_DIR", "outputs"),
+            retention_days=getattr(config, "OUTPUT_RETENTION_DAYS", 7),
+            max_total_gb=getattr(config, "OUTPUT_MAX_TOTAL_GB", 20),
+            gc_interval_seconds=getattr(config, "OUTPUT_GC_INTERVAL_SECONDS", 600),
+            artifact_level=getattr(config, "ARTIFACT_LEVEL", "key"),
+            writer_queue_size=getattr(config, "ARTIFACT_WRITER_QUEUE_SIZE", 32),
+            logger=logger,
+        )
+        self.output_store.start()
 
         self.templates = {}
         try:
@@ -123,32 +381,68 @@ class ImageGenerationPipeline:
             self.logger.warning(f"Could not load templates.json: {e}. Using a fallback template.")
             self.templates["white_default"] = {"name": "화이트(기본)"}
 
-    def _get_box(self, image: Image.Image, text_prompt: str, model_key_suffix: str) -> list[int] | None:
-        self.logger.info(f"Analyzing image to find '{text_prompt}'...")
+        cache_mb = getattr(config, "RESULT_CACHE_DISK_MB", 1024)
+        self.result_cache = ResultCache(getattr(config, "RESULT_CACHE_DIR", os.path.join("cache", "results")), cache_mb, logger) if cache_mb else None
+        # 같은 입력이라도 모델/템플릿/고정 프롬프트 구성이 바뀌면 결과가 달라지므로 캐시 키에 함께 넣습니다.
+        self._cache_context = {
+            "models": [getattr(config, name, None) for name in ("SDXL_BASE_MODEL_PATH", "REFINER_MODEL_PATH", "VAE_PATH", "CONTROLNET_CANNY_PATH", "IP_ADAPTER_WEIGHTS_PATH")],
+            "refiner_strength": getattr(config, "REFINER_STRENGTH", None),
+            "negative_prompt": self.negative_prompt,
+            "templates": self.templates,
+        }
+
+    def _load_sdxl_base(self):
+        """VAE와 SDXL base(UNet, 텍스트 인코더 1/2)를 한 번만 로드합니다. 배경/기본/ControlNet/리파이너가 모두 이를 공유합니다."""
+        vae = self.model_manager.load_model("vae", AutoencoderKL, self.config.VAE_PATH)
+        vae.enable_tiling()
+        pipe = self.model_manager.load_model("sdxl_base", StableDiffusionXLPipeline, self.config.SDXL_BASE_MODEL_PATH, vae=vae, use_fp16_variant=True, depends_on=("vae",))
+        precompute_prompt_embeds(pipe, self.negative_prompt)
+        return pipe
+
+    def _load_controlnet_pipe(self):
+        self._load_sdxl_base()
+        # 예산이 작으면(0 포함) ControlNet 로드가 방금 올린 base를 밀어내 from_pipe할 대상이 사라지므로 고정해 둡니다.
+        with self.model_manager.pinned("sdxl_base"):
+            controlnet = self.model_manager.load_model("controlnet_canny", ControlNetModel, self.config.CONTROLNET_CANNY_PATH, use_fp16_variant=True)
+            return self.model_manager.derive_pipeline("pipe_controlnet", StableDiffusionXLControlNetPipeline, "sdxl_base", controlnet=controlnet, depends_on=("controlnet_canny",))
+
+    def _load_refiner(self):
+        # 리파이너 프롬프트 임베딩은 base 단계에서 넘겨받으므로 텍스트 인코더 없이 UNet만 로드하고 VAE는 공유합니다.
+        vae = self.model_manager.load_model("vae", AutoencoderKL, self.config.VAE_PATH)
+        return self.model_manager.load_model("pipe_refiner", StableDiffusionXLImg2ImgPipeline, self.config.REFINER_MODEL_PATH, vae=vae, text_encoder_2=None, tokenizer_2=None, use_fp16_variant=True, depends_on=("vae",))
+
+    def _attach_ip_adapter(self, pipe):
+        """IP-Adapter 가중치를 붙입니다. CLIP 이미지 인코더는 캐시된 것을 재사용해 매 요청 다시 읽지 않습니다."""
+        base_path, encoder_folder = self.config.IP_ADAPTER_BASE_PATH, self.config.IP_ADAPTER_IMAGE_ENCODER_PATH
+        subfolder = os.path.relpath(os.path.dirname(self.config.IP_ADAPTER_WEIGHTS_PATH), base_path)
+        encoder_subfolder = encoder_folder if "/" in encoder_folder else os.path.join(subfolder, encoder_folder)
+        image_encoder = self.model_manager.load_model("ip_image_encoder", CLIPVisionModelWithProjection, base_path, subfolder=encoder_subfolder)
+        pipe.register_modules(image_encoder=image_encoder)
+        pipe.load_ip_adapter(base_path, subfolder=subfolder, weight_name=os.path.basename(self.config.IP_ADAPTER_WEIGHTS_PATH), image_encoder_folder=encoder_folder)
+
+    def _get_boxes(self, items: list[tuple[Image.Image, str]]) -> list[list[int] | None]:
+        """(이미지, 쿼리) 목록을 탐지기 한 번의 배치 호출로 처리합니다. 실패하면 모두 None."""
+        self.logger.info(f"Analyzing images to find {[query for _, query in items]}...")
         try:
-            processor = self.model_manager.load_model(f"dino_processor_{model_key_suffix}", GroundingDinoProcessor, self.config.GROUNDING_DINO_PATH)
-            model = self.model_manager.load_model(f"dino_model_{model_key_suffix}", AutoModelForZeroShotObjectDetection, self.config.GROUNDING_DINO_PATH, torch_dtype=torch.float32)
-            
-            inputs = processor(images=image, text=text_prompt, return_tensors="pt").to(self.config.DEVICE)
-            with torch.no_grad():
-                outputs = model(**inputs)
-            
-            original_size = image.size
-            target_sizes = torch.tensor([original_size[::-1]]).to(self.config.DEVICE)
-            results = processor.image_processor.post_process_object_detection(outputs, target_sizes=target_sizes, threshold=0.3)[0]
-
-            if len(results["boxes"]) > 0:
-                best_box = results["boxes"][0].cpu().numpy().astype(int)
-                self.logger.info(f"'{text_prompt}' area found at coordinates: {best_box.tolist()}")
-                return best_box.tolist()
-            else:
-                self.logger.warning(f"No suitable area for '{text_prompt}' found by Grounding DINO.")
-                return None
+            with self.stages.gpu(), stage("dino", gpu=True):
+                found = self.detector.detect([(image, [query]) for image, query in items])
+            return [boxes[query] for boxes, (_, query) in zip(found, items)]
         except Exception as e:
-            self.logger.error(f"Error during '{text_prompt}' analysis with Grounding DINO: {e}")
-            return None
-        finally:
-            self.model_manager.unload(f"dino_processor_{model_key_suffix}", f"dino_model_{model_key_suffix}")
+            self.logger.error(f"Error during Grounding DINO analysis: {e}")
+            return [None] * len(items)
+
+    def _matte(self, image: Image.Image) -> Image.Image:
+        with stage("rembg"):
+            if self.rembg_sessions is None: return remove(image)
+            # GPU 프로바이더를 쓰는 세션은 디퓨전과 같은 장치를 쓰므로 GPU 단계로 취급합니다.
+            with self.rembg_sessions.session() as session:
+                if not self.rembg_sessions.uses_gpu: return remove(image, session=session)
+                with self.stages.gpu(): return remove(image, session=session)
+
+    def _remove_background(self, image: Image.Image) -> Image.Image:
+        pool = self.rembg_sessions
+        namespace = "rembg_default" if pool is None else f"{pool.model_name}:{os.path.basename(pool.model_path)}" if pool.model_path else pool.model_name
+        return self.cutout_cache.get_or_compute(image, self._matte, namespace=namespace)
 
     def _create_composite_ip_image(self, model_image, product_image, base_image: Image.Image, interaction_detected: bool, relative_scale: float):
         self.logger.info("Compositing subjects onto the background...")
@@ -157,8 +451,8 @@ class ImageGenerationPipeline:
             canvas = base_image.copy().convert("RGBA")
             temp_canvas = Image.new("RGBA", (width, height), (0,0,0,0))
 
-            model_fg = remove(model_image, session=self.rembg_session) if model_image else None
-            product_fg = remove(product_image, session=self.rembg_session) if product_image else None
+            model_fg = self._remove_background(model_image) if model_image else None
+            product_fg = self._remove_background(product_image) if product_image else None
 
             if model_fg: model_fg.thumbnail((int(width * 0.95), int(height * 0.95)), Image.LANCZOS)
             
@@ -181,8 +475,12 @@ class ImageGenerationPipeline:
 
             if product_fg:
                 p_x, p_y = 0, 0
-                if model_fg and interaction_detected:
-                    hands_box = self._get_box(model_image, "a person's hands or animal's paws", "paws_placement")
+                # 배치 결정에 필요한 탐지(모델 이미지의 손/발, 배경의 놓을 자리)는 상주 탐지기 한 번의 호출로 처리하고
+                # 분기에 필요한 박스만 씁니다.
+                use_hands = bool(model_fg and interaction_detected)
+                detect_items = [(base_image, PLACEMENT_QUERY)] + ([(model_image, HANDS_QUERY)] if use_hands else [])
+                placement_box, hands_box = (self._get_boxes(detect_items) + [None])[:2]
+                if use_hands:
                     if hands_box:
                         self.logger.info("Placing product near detected hands or paws.")
                         hands_center_x = (hands_box[0] + hands_box[2]) // 2
@@ -194,7 +492,6 @@ class ImageGenerationPipeline:
                         p_x = m_x + (model_fg.width - product_fg.width) // 2
                         p_y = m_y + int(model_fg.height * 0.6)
                 else:
-                    placement_box = self._get_box(base_image, "the floor or the ground or a table", "bg_placement")
                     if placement_box:
                         box_center_x = (placement_box[0] + placement_box[2]) // 2
                         surface_top_y = placement_box[1]
@@ -221,199 +518,410 @@ class ImageGenerationPipeline:
         canny_image_np = np.stack([canny_image_np] * 3, axis=-1)
         return Image.fromarray(canny_image_np)
 
-    def run(self, inputs):
-        base_output_dir = "outputs"
-        os.makedirs(base_output_dir, exist_ok=True)
-        run_id = max(map(int, [d for d in os.listdir(base_output_dir) if d.isdigit()]), default=0) + 1
-        run_output_dir = os.path.join(base_output_dir, str(run_id))
-        output_manager = OutputManager(output_dir=run_output_dir, logger=self.logger)
-        self.logger.info(f"Output for this run will be saved to: {run_output_dir}")
-        
-        ad_prompt = None
-        base_image_latents = None
-        pipe = None
-        
+    def batch_key(self, inputs) -> tuple:
+        """같은 배치로 묶어 한 번의 디퓨전 호출로 돌릴 수 있는 요청인지 판단하는 키 (사이즈, 모드, 템플릿, 품질 티어, base/리파이너 분할)."""
+        params = inputs.get("params") or {}
+        mode = "layout" if (inputs.get("product_image") or inputs.get("model_image")) else "t2i"
+        profile = self._quality_profile(params)
+        return (params.get("size", "1024x1024"), mode, params.get("background"), profile["tier"], self._denoising_split(params, profile))
+
+    def _quality_profile(self, params: dict) -> dict:
+        """params.quality(없으면 config.DEFAULT_QUALITY) 티어의 생성 설정을 풀어서 돌려줍니다."""
+        tier = params.get("quality") or getattr(self.config, "DEFAULT_QUALITY", "premium")
+        if tier not in QUALITY_PROFILES: raise ValueError(f"Unknown quality tier '{tier}'")
+        profile = {**QUALITY_PROFILES[tier], **(getattr(self.config, "QUALITY_PROFILES", None) or {}).get(tier, {})}
+        lora = profile.pop("lora", None) or {}
+        lora_path = getattr(self.config, lora["path_config"], None) if lora.get("path_config") else None
+        if lora_path:
+            profile.update({k: v for k, v in lora.items() if k != "path_config"})
+        return {**profile, "tier": tier, "lora_path": lora_path}
+
+    def _with_scheduler(self, pipe, key: str, scheduler: str | None):
+        """key 파이프라인과 가중치를 모두 공유하고 스케줄러만 다른 변형 파이프라인을 돌려줍니다."""
+        if not scheduler: return pipe
+        scheduler_class, kwargs = SCHEDULERS[scheduler]
+        return self.model_manager.derive_pipeline(f"{key}:{scheduler}", type(pipe), key, scheduler=scheduler_class.from_config(pipe.scheduler.config, **kwargs))
+
+    def _apply_lora(self, pipe, lora_path: str | None):
+        """
+        few-step LoRA는 공유 UNet에 어댑터로 한 번만 올려 두고 호출마다 켜고 끕니다.
+        (배경/기본/ControlNet 파이프라인이 UNet을 공유하므로 LoRA가 없는 티어에서는 반드시 꺼야 합니다.)
+        """
+        adapters = pipe.get_list_adapters().get("unet", []) if hasattr(pipe, "get_list_adapters") else []
+        if lora_path:
+            name = re.sub(r"\W", "_", os.path.splitext(os.path.basename(lora_path.rstrip("/")))[0])
+            if name not in adapters:
+                self.logger.info(f"Loading few-step LoRA '{name}' from {lora_path}")
+                pipe.load_lora_weights(lora_path, adapter_name=name)
+            pipe.enable_lora()
+            pipe.set_adapters([name])
+        elif adapters:
+            pipe.disable_lora()
+
+    def _cached_result(self, job: "GenerationJob") -> dict | None:
+        """시드가 명시된 요청이면 결과 캐시 키를 정하고, 이전에 같은 요청의 결과가 있으면 그대로 돌려줍니다."""
+        if self.result_cache is None: return None
+        params = job.params
+        profile = self._quality_profile(params)
+        job.cache_key = fingerprint(job.inputs, {**self._cache_context, "profile": profile, "denoising_split": self._denoising_split(params, profile)})
+        cached = self.result_cache.get(job.cache_key) if job.cache_key else None
+        if cached is None: return None
+        meta, data = cached
+        self.logger.info(f"Result cache hit ({job.cache_key[:12]}), skipping generation.")
+        job.emit("stage", stage="cached")
+        result = {**meta, "cached": True}
+        if params.get("file_saved", True):
+            result["filepath"] = self.output_store.new_run().write_bytes(data, f"final_ad_{meta['seed']}", meta["format"])
+        else:
+            result["image_bytes"] = data
+        return result
+
+    def _detect_category(self, prompt_text: str, product_image_b64: str | None) -> str:
         try:
-            params = inputs.get("params", {})
-            prompt_text = inputs.get("prompt")
-            product_image_b64 = inputs.get("product_image")
-            
-            product_image = self._load_b64(product_image_b64)
-            model_image = self._load_b64(inputs.get("model_image"))
-
-            width, height = map(int, params.get("size", "1024x1024").split("x"))
-            seed = int(params.get("seed")) if params.get("seed") is not None else torch.randint(0, 2**32-1, (1,)).item()
-            generator = torch.Generator(device=self.config.DEVICE).manual_seed(seed)
-            self.logger.info(f"Input loaded. Size: {width}x{height}, Seed: {seed}")
+            self.logger.info("Automatically detecting product category...")
+            with stage("llm_category"):
+                return _get_product_category_from_llm(prompt_text, product_image_b64, self.config.OPENAI_API_KEY, self.logger)
+        except Exception as e:
+            self.logger.warning(f"Could not detect product category: {e}. Falling back to 'other'.")
+            return "other"
+
+    def _compose_prompt(self, job: "GenerationJob", category_future) -> dict:
+        job.inputs["product_category"] = category_future.result()
+        job.emit("stage", stage="compose_prompt")
+        with stage("llm_compose"):
+            return build_ad_prompt_compose(None, {**job.inputs, **job.llm_images}, logger=self.logger, openai_api_key=self.config.OPENAI_API_KEY)
+
+    def _denoising_split(self, params: dict, profile: dict) -> float | None:
+        """
+        ensemble-of-experts 분할 지점. 값이 있으면 base는 스케줄의 앞부분(denoising_end)까지만,
+        리파이너는 같은 스케줄의 나머지(denoising_start)만 디노이즈합니다. None이면 기존 방식(base 전체 + 리파이너 img2img).
+        리파이너를 쓰지 않는 티어는 base가 끝까지 디노이즈해야 하므로 항상 None입니다.
+        """
+        if not profile["refiner"]: return None
+        split = params.get("denoising_end")
+        if split is None: split = getattr(self.config, "ENSEMBLE_DENOISING_END", None)
+        return float(split) if split else None
+
+    def _prepare(self, job: "GenerationJob"):
+        """LLM 분석, 템플릿 선택, 배경/합성/Canny 준비까지 — base 디퓨전 직전 단계입니다."""
+        inputs, params = job.inputs, job.params
+        job.emit("stage", stage="prepare")
+        prompt_text = inputs.get("prompt")
+        product_image_b64 = inputs.get("product_image")
+
+        with stage("decode"):
+            job.product_image = product_image = self._load_b64(product_image_b64)
+            job.model_image = model_image = self._load_b64(inputs.get("model_image"))
+
+        job.width, job.height = width, height = map(int, params.get("size", "1024x1024").split("x"))
+        job.seed = seed = int(params.get("seed")) if params.get("seed") is not None else torch.randint(0, 2**32-1, (1,)).item()
+        job.generator = generator = torch.Generator(device=self.config.DEVICE).manual_seed(seed)
+        self.logger.info(f"Input loaded. Size: {width}x{height}, Seed: {seed}")
+        job.profile = self._quality_profile(params)
+        job.denoising_split = self._denoising_split(params, job.profile)
+
+        # LLM에는 원본 업로드 대신 한 번 축소/재인코딩한 이미지를 보내고, 모든 LLM 호출이 이를 같이 씁니다.
+        job.llm_images = {name: prepare_llm_image(img) for name, img in (("product_image", product_image), ("model_image", model_image)) if img is not None}
+        # LLM 호출(카테고리 → 프롬프트 합성)은 기다리지 않고 띄워 두고, 모델 로드/배경 생성/rembg와 겹쳐 실행합니다.
+        category_future = self.stages.submit_io(self._detect_category, prompt_text, job.llm_images.get("product_image"))
+
+        background_input = params.get("background")
+        background_map = {t.get("name"): t_id for t_id, t in self.templates.items() if isinstance(t, dict) and t.get("name")}
+        job.template_id = template_id = background_map.get(background_input, "white_default")
+        template = self.templates.get(template_id) or self.templates["white_default"]
+        self.logger.info(f"Using template: '{template.get('name', template_id)}'")
+        params["template_hint"] = template.get("main_prompt_hint")
+        params["placement_hint"] = template.get("placement_hint")
+        # 프롬프트 합성은 템플릿 힌트만 있으면 되므로 GPU 잠금을 기다리지 않고 바로 띄웁니다.
+        compose_future = self.stages.submit_io(self._compose_prompt, job, category_future)
+
+        is_image_provided = product_image or model_image
+
+        if not is_image_provided:
+            self.logger.info("Running in Text-to-Image mode.")
+            job.mode = "t2i"
+            job.ad_prompt = compose_future.result()["final_prompt_en"]
+            return
+
+        self.logger.info("Running in AI Auto-Layout mode.")
+        job.mode = "layout"
+        output_manager = job.output_manager
+
+        background_prompt = template.get("background_prompt")
+        profile = job.profile
+        # 합성 배치는 LLM 결과(interaction_detected)를 기다리지만 컷아웃은 그렇지 않으므로 미리 캐시에 올려 둡니다.
+        # GPU 잠금 전에 띄워 다른 배치의 디퓨전이나 모델 로드와 겹치게 합니다.
+        cutout_futures = [self.stages.submit_io(self._remove_background, img) for img in (model_image, product_image) if img is not None]
+        background_entry = self.background_library.pick(template_id, width, height, seed) if params.get("use_background_library", True) else None
+        if background_entry is not None:
+            background_image = background_entry.image
+        else:
+            with self.stages.gpu():
+                job.emit("stage", stage="background")
+                with stage("model_load", gpu=True):
+                    bg_pipe = self._with_scheduler(self._load_sdxl_base(), "sdxl_base", profile["scheduler"])
+                    self._apply_lora(bg_pipe, profile["lora_path"])
+                with stage("background", gpu=True):
+                    background_image = bg_pipe(prompt=background_prompt, num_inference_steps=profile["background_steps"], guidance_scale=profile["guidance_scale"], generator=generator, width=width, height=height, callback_on_step_end=self._step_callback([job], "background")).images[0]
+        output_manager.artifact(background_image, "00_generated_background", "key")
+
+        for future in cutout_futures:
+            try: future.result()
+            except Exception as e: self.logger.warning(f"Background removal prefetch failed, will retry during compositing: {e}")
+        llm_data = compose_future.result()
+        job.ad_prompt = llm_data["final_prompt_en"]
+        interaction_detected = llm_data["interaction_detected"]
+
+        relative_scale = 0.55
+
+        job.emit("stage", stage="composite")
+        with stage("composite"):
+            job.condition_image = self._create_composite_ip_image(model_image, product_image, background_image, interaction_detected, relative_scale)
+        output_manager.artifact(job.condition_image, "00_condition_image_with_bg", "key")
+        with stage("canny"):
+            job.canny_image = self._prepare_canny_image(job.condition_image)
+        output_manager.artifact(job.canny_image, "00_canny_control_image", "all")
+
+        del background_image
+
+        if model_image is None and product_image is not None:
+            self.logger.info("Product only mode detected. Prioritizing style and texture.")
+            controlnet_scale = 0.4
+            ip_adapter_scale = 0.7
+        elif interaction_detected:
+            self.logger.info("Interaction detected. Balancing structural control and creative freedom.")
+            controlnet_scale = 0.55 
+            ip_adapter_scale = 0.3
+        elif template_id == "white_default" and model_image:
+            self.logger.info("Studio concept hallucination detected. Adjusting scales for 'white_default' template.")
+            ip_adapter_scale = 0.35
+            controlnet_scale = 0.65 
+        else:
+            self.logger.info("No special conditions detected. Using template default scales.")
+            controlnet_scale = template.get("controlnet_scale", 0.4)
+            ip_adapter_scale = template.get("ip_adapter_scale", 0.6)
+        job.controlnet_scale, job.ip_adapter_scale = controlnet_scale, ip_adapter_scale
+        self.logger.info(f"[COND] Using scales: ip_scale={ip_adapter_scale}, control_scale={controlnet_scale}")
+
+    @staticmethod
+    def _stack_embeds(embeds_list: list[dict]) -> dict:
+        return {k: torch.cat([e[k] for e in embeds_list], dim=0) for k in embeds_list[0]}
+
+    def _step_callback(self, jobs: list["GenerationJob"], stage: str):
+        """diffusers callback_on_step_end: 스텝 진행률과 가끔 저해상도 미리보기를 내보내고, 배치 전체가 취소되면 중단합니다."""
+        preview_every = getattr(self.config, "PREVIEW_EVERY_STEPS", 5)
+        def callback(pipe, step, timestep, callback_kwargs):
+            total, latents = getattr(pipe, "num_timesteps", None), callback_kwargs.get("latents")
+            with_preview = bool(preview_every) and latents is not None and (step + 1) % preview_every == 0
+            for i, job in enumerate(jobs):
+                event = {"stage": stage, "step": step + 1, "total": total}
+                if with_preview and job.on_event is not None: event["preview"] = _latent_preview(latents[i])
+                job.emit("step", **event)
+            if all(job.cancelled for job in jobs): pipe._interrupt = True
+            return callback_kwargs
+        return callback
+
+    def _generate_base(self, jobs: list["GenerationJob"]):
+        """모드/사이즈가 같은 job들을 한 번의 base(또는 ControlNet) 디퓨전 호출로 생성합니다."""
+        width, height, profile = jobs[0].width, jobs[0].height, jobs[0].profile
+        for job in jobs: job.emit("stage", stage="base")
+        if jobs[0].mode == "t2i":
+            with stage("model_load", gpu=True):
+                pipe = self._with_scheduler(self._load_sdxl_base(), "sdxl_base", profile["scheduler"])
+                self._apply_lora(pipe, profile["lora_path"])
+            with stage("base", gpu=True):
+                for job in jobs: job.prompt_embeds = encode_prompt_sdxl(pipe, job.ad_prompt, self.negative_prompt)
+                latents = pipe(**self._stack_embeds([j.prompt_embeds for j in jobs]), num_inference_steps=profile["base_steps"], guidance_scale=profile["guidance_scale"], generator=[j.generator for j in jobs], width=width, height=height, denoising_end=jobs[0].denoising_split, output_type="latent", callback_on_step_end=self._step_callback(jobs, "base")).images
+            for job, lat in zip(jobs, latents): job.base_latents = lat.unsqueeze(0)
+            return pipe
+
+        with stage("model_load", gpu=True):
+            pipe = self._with_scheduler(self._load_controlnet_pipe(), "pipe_controlnet", profile["scheduler"])
+            self._apply_lora(pipe, profile["lora_path"])
+            with self.model_manager.pinned("pipe_controlnet"): self._attach_ip_adapter(pipe)
+        try:
+            # ControlNet/IP-Adapter 스케일은 호출 단위 값이므로 같은 스케일끼리 다시 묶습니다.
+            groups = {}
+            for job in jobs: groups.setdefault((job.controlnet_scale, job.ip_adapter_scale), []).append(job)
+            for (controlnet_scale, ip_adapter_scale), group in groups.items():
+                with recording(*[job.timings for job in group]), stage("controlnet", gpu=True):
+                    pipe.set_ip_adapter_scale(ip_adapter_scale)
+                    ip_embeds = []
+                    for job in group:
+                        job.prompt_embeds = encode_prompt_sdxl(pipe, job.ad_prompt, self.negative_prompt)
+                        ip_embeds.append(pipe.prepare_ip_adapter_image_embeds(job.condition_image, None, self.config.DEVICE, 1, True)[0].chunk(2))
+                    # 배치 IP-Adapter 임베딩 형식: [negative_1..n, positive_1..n]
+                    ip_adapter_image_embeds = [torch.cat([neg for neg, _ in ip_embeds] + [pos for _, pos in ip_embeds], dim=0)]
+                    latents = pipe(**self._stack_embeds([j.prompt_embeds for j in group]), image=[j.canny_image for j in group], ip_adapter_image_embeds=ip_adapter_image_embeds, num_inference_steps=profile["base_steps"], guidance_scale=profile["guidance_scale"], generator=[j.generator for j in group], width=width, height=height, controlnet_conditioning_scale=controlnet_scale, denoising_end=jobs[0].denoising_split, output_type="latent", callback_on_step_end=self._step_callback(group, "base")).images
+                    for job, lat in zip(group, latents): job.base_latents = lat.unsqueeze(0)
+        finally:
+            # UNet을 배경/기본 파이프라인과 공유하므로 IP-Adapter 어텐션 프로세서를 원래대로 돌려놓습니다.
+            pipe.unload_ip_adapter()
+        return pipe
+
+    def _save_base_output(self, job: "GenerationJob", pipe):
+        # 리파이너를 쓰지 않는 티어는 base 디코드 결과가 곧 최종 이미지입니다.
+        # 그 외에는 디버그 파일을 위해 VAE 디코드가 한 번 더 필요하므로 artifact_level=all일 때만 만듭니다.
+        is_final = not job.profile["refiner"]
+        if not (is_final or job.output_manager.wants_artifact("all")): return
+        with torch.no_grad(), stage("vae_decode", gpu=True):
+            temp_vae = pipe.vae if pipe and hasattr(pipe, 'vae') else self._load_sdxl_base().vae
+            temp_vae.to(self.config.DEVICE)
+            base_image_latents_scaled = job.base_latents.to(self.config.DEVICE, dtype=temp_vae.dtype) / temp_vae.config.scaling_factor
+            decoded_image_tensor = temp_vae.decode(base_image_latents_scaled, return_dict=False)[0]
+
+            image_processor = pipe.image_processor if pipe and hasattr(pipe, 'image_processor') else self._load_sdxl_base().image_processor
+
+            intermediate_image = image_processor.postprocess(decoded_image_tensor.cpu(), output_type="pil")[0]
+            if is_final: job.final_image = intermediate_image
+            job.output_manager.artifact(intermediate_image, "01_base_generation_output", "all")
+
+    def _refine(self, jobs: list["GenerationJob"]):
+        self.logger.info(f"Running Refiner pipeline (batch={len(jobs)})...")
+        for job in jobs: job.emit("stage", stage="refiner")
+        for job in jobs:
+            if job.ad_prompt is None:
+                job.ad_prompt = build_ad_prompt_compose(None, {**job.inputs, **job.llm_images}, logger=self.logger, openai_api_key=self.config.OPENAI_API_KEY)["final_prompt_en"]
+            if job.prompt_embeds is None:
+                job.prompt_embeds = encode_prompt_sdxl(self._load_sdxl_base(), job.ad_prompt, self.negative_prompt)
+        profile = jobs[0].profile
+        with stage("model_load", gpu=True):
+            refiner_pipe = self._with_scheduler(self._load_refiner(), "pipe_refiner", profile["scheduler"])
+        # 리파이너는 base와 같은 OpenCLIP-bigG(text_encoder_2)만 쓰므로 base 단계 임베딩의 해당 부분을 그대로 넘깁니다.
+        dim = refiner_pipe.unet.config.cross_attention_dim
+        refiner_embeds = self._stack_embeds([text_encoder_2_embeds(j.prompt_embeds, dim) for j in jobs])
+        latents = torch.cat([j.base_latents for j in jobs], dim=0).to(self.config.DEVICE)
+        # denoising_start가 있으면 strength는 무시되고 base와 같은 스텝 수의 스케줄에서 나머지 구간만 실행됩니다.
+        steps = profile["base_steps"] if jobs[0].denoising_split else profile["refiner_steps"]
+        with stage("refiner", gpu=True):
+            images = refiner_pipe(**refiner_embeds, image=latents, num_inference_steps=steps, strength=self.config.REFINER_STRENGTH, denoising_start=jobs[0].denoising_split, generator=[j.generator for j in jobs], callback_on_step_end=self._step_callback(jobs, "refiner")).images
+        for job, image in zip(jobs, images): job.final_image = image
+
+    def _finish(self, job: "GenerationJob") -> dict:
+        """최종 이미지를 output_format/output_quality로 한 번만 인코딩합니다. 저장하지 않으면 바이트를 그대로 돌려줍니다 (JSON 변환은 API 계층)."""
+        fmt = job.params.get("output_format") or "png"
+        with recording(job.timings), stage("encode"):
+            data = encode_image(job.final_image, fmt, job.params.get("output_quality"))
+        result = {"status": "success", "seed": job.seed, "format": fmt, "mime_type": IMAGE_FORMATS[fmt][2], "quality": job.profile["tier"], "denoising_split": job.denoising_split}
+        if job.cache_key:
+            try: self.result_cache.put(job.cache_key, result, data)
+            except OSError as e: self.logger.warning(f"Could not write result cache entry: {e}")
+        if job.params.get("file_saved", True):
+            result["filepath"] = job.output_manager.write_bytes(data, f"final_ad_{job.seed}", fmt)
+        else:
+            result["image_bytes"] = data
+        return self._complete(job, result)
+
+    def _complete(self, job: "GenerationJob", result: dict, outcome: str = "generated") -> dict:
+        """단계 기록을 Prometheus 히스토그램에 반영하고, params.timings가 켜져 있으면 결과에 단계별 요약을 붙입니다."""
+        job.timings.observe(outcome)
+        if job.params.get("timings"): result["timings"] = job.timings.summary()
+        return result
 
+    def run(self, inputs):
+        result = self.run_batch([inputs])[0]
+        if isinstance(result, Exception): raise result
+        return result
+
+    def run_batch(self, inputs_list: list[dict]) -> list:
+        """
+        여러 요청을 한 번에 처리합니다. 준비 단계는 요청별로 CPU 워커 풀에서 동시에, 디퓨전(base/ControlNet, 리파이너)은
+        모드·사이즈·품질 티어·base/리파이너 분할 지점이 같은 요청끼리 배치로 실행합니다. 결과 리스트에는 성공 시 dict, 실패 시 예외가 들어갑니다.
+        GPU 단계는 self.stages.gpu() 장치 잠금 안에서만 실행되어, 다른 배치의 GPU 작업과 겹치지 않고 CPU 준비와는 겹칩니다.
+        """
+        jobs = [GenerationJob(inputs) for inputs in inputs_list]
+        results = [None] * len(jobs)
+
+        def prepare(i):
+            job = jobs[i]
             try:
-                self.logger.info("Automatically detecting product category...")
-                product_category = _get_product_category_from_llm(
-                    prompt_text,
-                    product_image_b64,
-                    self.config.OPENAI_API_KEY,
-                    self.logger
-                )
-                    if product_fg:
-                is_interaction_forced = (subject_image is not None)
-
-                if not is_for_canny_map and is_interaction_forced:
-                    self.logger.info("IP-Adapter mode: Subject exists, attempting to place product near paws.")
-                    paws_box = self._get_box(subject_image, "animal's paws or feet", "paws_placement", processor=dino_processor, model=dino_model)
-                    
-                    if paws_box:
-                        self.logger.info("Paws detected. Placing product centered above the paws.")
-                        paws_center_x = (paws_box[0] + paws_box[2]) // 2
-                        paws_top_y = paws_box[1] 
-                        p_x = paws_center_x - product_fg.width // 2
-                        p_y = paws_top_y - int(product_fg.height * 0.8) 
-                    else:
-                        self.logger.warning("Could not find paws, falling back to lower center placement.")
-                        if subject_fg:
-                            m_x_ref = (width - subject_fg.width) // 2
-                            m_y_ref = height - subject_fg.height
-                            p_x = m_x_ref + (subject_fg.width - product_fg.width) // 2
-                            p_y = m_y_ref + int(subject_fg.height * 0.6)
-                        else:
-                            self.logger.warning("Could not process model image, placing product at image center.")
-                            p_x = (width - product_fg.width) // 2
-                            p_y = (height - product_fg.height) // 2
-
-                    p_x, p_y = max(0, min(p_x, width-product_fg.width)), max(0, min(p_y, height-product_fg.height))
-                    temp_canvas.paste(product_fg, (p_x, p_y), product_fg)
-                
-                elif not is_for_canny_map and not is_interaction_forced:
+                if job.cancelled: raise GenerationCancelled("Generation cancelled before start")
+                results[i] = self._cached_result(job)
+                if results[i] is not None:
+                    self._complete(job, results[i], "cached")
+                    return
+                job.output_manager = self.output_store.new_run(job.params.get("artifact_level"))
+                with recording(job.timings): self._prepare(job)
+            except Exception as e:
+                results[i] = e
 
-            template_id = background_map.get(background_input, "white_default")
-            template = self.templates.get(template_id) or self.templates["white_default"]
-            self.logger.info(f"Using template: '{template.get('name', template_id)}'")
-            params["template_hint"] = template.get("main_prompt_hint")
-            params["placement_hint"] = template.get("placement_hint")
-
-            is_image_provided = product_image or model_image
-            
-            if not is_image_provided:
-                self.logger.info("Running in Text-to-Image mode.")
-                vae = self.model_manager.load_model("vae", AutoencoderKL, self.config.VAE_PATH)
-                pipe = self.model_manager.load_model("pipe_base", StableDiffusionXLPipeline, self.config.SDXL_BASE_MODEL_PATH, vae=vae, use_fp16_variant=True)
-                pipe.vae.enable_tiling()
-                
-                llm_data = build_ad_prompt_compose(pipe.tokenizer_2, inputs, logger=self.logger, openai_api_key=self.config.OPENAI_API_KEY)
-                ad_prompt = llm_data["final_prompt_en"]
-                base_image_latents = pipe(**encode_prompt_sdxl(pipe, ad_prompt, self.negative_prompt), num_inference_steps=40, generator=generator, width=width, height=height, output_type="latent").images
-            
-            else:
-                self.logger.info("Running in AI Auto-Layout mode.")
-                
-                background_prompt = template.get("background_prompt")
-                vae_bg = self.model_manager.load_model("vae_for_bg", AutoencoderKL, self.config.VAE_PATH)
-                bg_pipe = self.model_manager.load_model("pipe_base_for_bg", StableDiffusionXLPipeline, self.config.SDXL_BASE_MODEL_PATH, vae=vae_bg, use_fp16_variant=True)
-                background_image = bg_pipe(prompt=background_prompt, num_inference_steps=25, generator=generator, width=width, height=height).images[0]
-                output_manager.save(background_image, "00_generated_background")
-                
-                self.model_manager.unload("pipe_base_for_bg", "vae_for_bg")
-
-                from transformers import CLIPTokenizer
-                tokenizer_for_llm = CLIPTokenizer.from_pretrained(self.config.SDXL_BASE_MODEL_PATH, subfolder="tokenizer_2")
-                llm_data = build_ad_prompt_compose(tokenizer_for_llm, inputs, logger=self.logger, openai_api_key=self.config.OPENAI_API_KEY)
-                ad_prompt = llm_data["final_prompt_en"]
-                interaction_detected = llm_data["interaction_detected"]
-                del tokenizer_for_llm
-
-                relative_scale = 0.55
-                
-                condition_image = self._create_composite_ip_image(model_image, product_image, background_image, interaction_detected, relative_scale)
-                output_manager.save(condition_image, "00_condition_image_with_bg")
-                canny_image = self._prepare_canny_image(condition_image)
-                output_manager.save(canny_image, "00_canny_control_image")
-
-                del background_image
-                if torch.cuda.is_available(): torch.cuda.empty_cache()
-
-                vae = self.model_manager.load_model("vae_cn", AutoencoderKL, self.config.VAE_PATH)
-                controlnet = self.model_manager.load_model("controlnet_canny", ControlNetModel, self.config.CONTROLNET_CANNY_PATH, use_fp16_variant=True)
-                pipe = self.model_manager.load_model("pipe_controlnet", StableDiffusionXLControlNetPipeline, self.config.SDXL_BASE_MODEL_PATH, vae=vae, controlnet=controlnet, use_fp16_variant=True)
-                
-                pipe.load_ip_adapter(self.config.IP_ADAPTER_BASE_PATH, subfolder=os.path.relpath(os.path.dirname(self.config.IP_ADAPTER_WEIGHTS_PATH), self.config.IP_ADAPTER_BASE_PATH), weight_name=os.path.basename(self.config.IP_ADAPTER_WEIGHTS_PATH), image_encoder_folder=self.config.IP_ADAPTER_IMAGE_ENCODER_PATH)
-                
-                if model_image is None and product_image is not None:
-                    self.logger.info("Product only mode detected. Prioritizing style and texture.")
-                    controlnet_scale = 0.4
-                    ip_adapter_scale = 0.7
-                elif interaction_detected:
-                    self.logger.info("Interaction detected. Balancing structural control and creative freedom.")
-                    controlnet_scale = 0.55 
-                    ip_adapter_scale = 0.3
-                elif template_id == "white_default" and model_image:
-                    self.logger.info("Studio concept hallucination detected. Adjusting scales for 'white_default' template.")
-                    ip_adapter_scale = 0.35
-                    controlnet_scale = 0.65 
-                else:
-                    self.logger.info("No special conditions detected. Using template default scales.")
-                    controlnet_scale = template.get("controlnet_scale", 0.4)
-                    ip_adapter_scale = template.get("ip_adapter_scale", 0.6)
-
-                pipe.set_ip_adapter_scale(ip_adapter_scale)
-                self.logger.info(f"[COND] Using scales: ip_scale={ip_adapter_scale}, control_scale={controlnet_scale}")
-                
-                base_image_latents = pipe(**encode_prompt_sdxl(pipe, ad_prompt, self.negative_prompt), image=canny_image, ip_adapter_image=condition_image, num_inference_steps=40, generator=generator, width=width, height=height, controlnet_conditioning_scale=controlnet_scale, output_type="latent").images
-
-            self.logger.info("Base generation complete. Saving intermediate image and clearing VRAM.")
-            if base_image_latents is not None:
-                with torch.no_grad():
-                    temp_vae = pipe.vae if pipe and hasattr(pipe, 'vae') else self.model_manager.load_model("vae_temp_decode", AutoencoderKL, self.config.VAE_PATH)
-                    temp_vae.to(self.config.DEVICE)
-                    base_image_latents_scaled = base_image_latents.to(self.config.DEVICE, dtype=temp_vae.dtype) / temp_vae.config.scaling_factor
-                    decoded_image_tensor = temp_vae.decode(base_image_latents_scaled, return_dict=False)[0]
-                    
-                    if pipe and hasattr(pipe, 'image_processor'):
-                        image_processor = pipe.image_processor
-                    else:
-                        temp_pipe = StableDiffusionXLPipeline.from_pretrained(self.config.SDXL_BASE_MODEL_PATH, torch_dtype=self.config.TORCH_DTYPE, use_safetensors=True)
-                        image_processor = temp_pipe.image_processor
-                        del temp_pipe
-
-                    intermediate_image = image_processor.postprocess(decoded_image_tensor.cpu(), output_type="pil")[0]
-                    output_manager.save(intermediate_image, "01_base_generation_output")
-                
-                base_image_latents = base_image_latents.cpu()
-
-            self.model_manager.unload() 
-            if 'pipe' in locals() and pipe is not None: del pipe
-            if 'controlnet' in locals() and controlnet is not None: del controlnet
-            if 'bg_pipe' in locals() and bg_pipe is not None: del bg_pipe
-            if 'condition_image' in locals(): del condition_image
-            if 'canny_image' in locals(): del canny_image
-            if torch.cuda.is_available(): torch.cuda.empty_cache()
-
-            self.logger.info("Running Refiner pipeline...")
-            vae_refiner = self.model_manager.load_model("vae_refiner", AutoencoderKL, self.config.VAE_PATH)
-            refiner_pipe = self.model_manager.load_model("pipe_refiner", StableDiffusionXLImg2ImgPipeline, self.config.REFINER_MODEL_PATH, vae=vae_refiner, use_fp16_variant=True)
-            refiner_pipe.vae.enable_tiling()
-            
-            if ad_prompt is None:
-                if 'llm_data' in locals() and llm_data and llm_data.get("final_prompt_en"):
-                    ad_prompt = llm_data["final_prompt_en"]
-                else: 
-                    tokenizer = refiner_pipe.tokenizer_2 if hasattr(refiner_pipe, 'tokenizer_2') else None
-                    llm_data = build_ad_prompt_compose(tokenizer, inputs, logger=self.logger, openai_api_key=self.config.OPENAI_API_KEY)
-                    ad_prompt = llm_data["final_prompt_en"]
-
-            final_image = refiner_pipe(prompt=ad_prompt, negative_prompt=self.negative_prompt, image=base_image_latents.to(self.config.DEVICE), num_inference_steps=40, strength=self.config.REFINER_STRENGTH, generator=generator).images[0]
-
-            if params.get("file_saved", True):
-                path = output_manager.save(final_image, f"final_ad_{seed}")
-                return {"status": "success", "filepath": path, "seed": seed}
-            else:
-                return {"status": "success", "image_base64": output_manager.to_base64(final_image), "seed": seed}
+        try:
+            self.stages.map_cpu(prepare, range(len(jobs)))
+            ready = [i for i in range(len(jobs)) if results[i] is None]
+
+            groups = {}
+            for i in ready: groups.setdefault((jobs[i].mode, jobs[i].width, jobs[i].height, jobs[i].profile["tier"], jobs[i].denoising_split), []).append(i)
+            for idx in groups.values():
+                for i in idx:
+                    if jobs[i].cancelled: results[i] = GenerationCancelled("Generation cancelled")
+                idx = [i for i in idx if results[i] is None]
+                if not idx: continue
+                group = [jobs[i] for i in idx]
+                try:
+                    with self.stages.gpu():
+                        with recording(*[job.timings for job in group]): pipe = self._generate_base(group)
+                        self.logger.info("Base generation complete. Saving intermediate image and clearing VRAM.")
+                        for job in group:
+                            with recording(job.timings): self._save_base_output(job, pipe)
+                            job.base_latents = job.base_latents.cpu()
+                            job.condition_image = job.canny_image = None
+                        del pipe
+                        self.model_manager.trim()
+                        if torch.cuda.is_available(): torch.cuda.empty_cache()
+
+                    for i, job in zip(idx, group):
+                        if job.cancelled: results[i] = GenerationCancelled("Generation cancelled")
+                    idx = [i for i in idx if results[i] is None]
+                    group = [jobs[i] for i in idx]
+                    if not group: continue
+
+                    if group[0].profile["refiner"]:
+                        with self.stages.gpu(), recording(*[job.timings for job in group]): self._refine(group)
+                    # 최종 인코딩은 CPU 단계이므로 잠금 밖에서 요청별로 동시에 처리합니다.
+                    for i, result in zip(idx, self.stages.map_cpu(self._finish, group)): results[i] = result
+                except Exception as e:
+                    for i in idx:
+                        if results[i] is None: results[i] = e
+            for job, result in zip(jobs, results):
+                if isinstance(result, Exception): job.timings.observe("cancelled" if isinstance(result, GenerationCancelled) else "failed")
+            return results
 
         finally:
-            self.model_manager.unload()
-            if torch.cuda.is_available(): torch.cuda.empty_cache()
+            with self.stages.gpu():
+                self.model_manager.trim()
+                if torch.cuda.is_available(): torch.cuda.empty_cache()
+            self.logger.info(f"Model cache stats: {self.model_manager.stats()}, cutout cache stats: {self.cutout_cache.stats()}, result cache stats: {self.result_cache.stats() if self.result_cache else None}, stage stats: {self.stages.stats()}")
 
     def _load_b64(self, b64_str):
+        """
+        업로드 이미지를 한 번만 디코드합니다. 바이트/픽셀 한도는 헤더만 읽은 상태에서 확인하고,
+        JPEG은 draft로 디코드 단계에서부터 작업 해상도(INPUT_MAX_SIDE) 근처로 줄여 읽습니다.
+        """
         if not b64_str: return None
-        return Image.open(io.BytesIO(base64.b64decode(b64_str))).convert("RGB")
+        max_bytes = getattr(self.config, "INPUT_MAX_BYTES", 25 * 1024**2)
+        max_pixels = getattr(self.config, "INPUT_MAX_PIXELS", 50_000_000)
+        max_side = getattr(self.config, "INPUT_MAX_SIDE", 2048)
+        if len(b64_str) * 3 // 4 > max_bytes:
+            raise InputImageError(f"Image exceeds {max_bytes // 1024**2}MB upload limit")
+        try:
+            image = Image.open(io.BytesIO(base64.b64decode(b64_str)))
+        except Exception as e:
+            raise InputImageError(f"Could not decode image: {e}")
+        width, height = image.size
+        if width * height > max_pixels:
+            raise InputImageError(f"Image has {width}x{height} pixels, exceeding the {max_pixels} pixel limit")
+        # 헤더만 멀쩡하고 본문이 잘리거나 깨진 업로드는 실제 디코드(draft/convert)에서 실패하므로 함께 400으로 돌립니다.
+        try:
+            if max(width, height) > max_side:
+                scale = max_side / max(width, height)
+                # draft는 요청 크기 이상을 유지하는 가장 큰 1/2^n 축소를 고릅니다 (JPEG 외 포맷은 무시).
+                image.draft("RGB", (max(1, int(width * scale)), max(1, int(height * scale))))
+            image = image.convert("RGB")
+            if max(image.size) > max_side:
+                image.thumbnail((max_side, max_side), Image.LANCZOS)
+        except Exception as e:
+            raise InputImageError(f"Could not decode image: {e}")
+        return image
 
     def _merge_side_by_side(self, left, right, target_height=1024):
         if left.mode != "RGB": left = left.convert("RGB")
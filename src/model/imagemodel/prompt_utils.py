@@ -4,15 +4,95 @@
 # [UPDATE] AI Vision을 통한 모델 타입 분석 기능(_get_model_type_from_llm) 추가
 # =======================================
 from __future__ import annotations
-import os, re, json, time
+import os, io, re, json, time, base64, binascii, threading, weakref
+from collections import OrderedDict
 from typing import Optional, Dict
 import torch
 import config
+from llm_cache import LLMCache
 
 _HAS_OPENAI = True
-try: from openai import OpenAI
+try: from openai import OpenAI, DefaultHttpxClient
 except Exception: _HAS_OPENAI = False; OpenAI = None
 
+# 프로세스 공용 OpenAI 클라이언트. 호출마다 새 클라이언트(=새 TLS 연결)를 만들지 않고 keep-alive 연결 풀을 재사용합니다.
+_OPENAI_MAX_CONNECTIONS = getattr(config, "OPENAI_MAX_CONNECTIONS", 20)
+_OPENAI_MAX_RETRIES = getattr(config, "OPENAI_MAX_RETRIES", 2)
+# 호출 종류별 deadline(초)
+_CLASSIFY_TIMEOUT = getattr(config, "OPENAI_CLASSIFY_TIMEOUT", 15)
+_COMPOSE_TIMEOUT = getattr(config, "OPENAI_COMPOSE_TIMEOUT", 45)
+_OPENAI_CLIENTS = {}
+_openai_client_lock = threading.Lock()
+
+def _http_limits():
+    import httpx
+    return httpx.Limits(max_connections=_OPENAI_MAX_CONNECTIONS, max_keepalive_connections=_OPENAI_MAX_CONNECTIONS, keepalive_expiry=60)
+
+def get_openai_client(api_key: Optional[str]) -> "OpenAI":
+    if not (api_key and _HAS_OPENAI and OpenAI): raise RuntimeError("OpenAI not available")
+    with _openai_client_lock:
+        client = _OPENAI_CLIENTS.get(api_key)
+        if client is None:
+            client = _OPENAI_CLIENTS[api_key] = OpenAI(api_key=api_key, max_retries=_OPENAI_MAX_RETRIES, timeout=_COMPOSE_TIMEOUT, http_client=DefaultHttpxClient(limits=_http_limits()))
+        return client
+
+# LLM 응답 영속 캐시. 분류 호출(카테고리/모델 타입)은 기본으로 캐시하고,
+# 결과가 매번 달라질 수 있는 프롬프트 합성은 LLM_CACHE_COMPOSE=True일 때만 캐시합니다. (LLM_CACHE_PATH가 비면 끔)
+_LLM_CACHE_PATH = getattr(config, "LLM_CACHE_PATH", os.path.join("cache", "llm_cache.sqlite3"))
+_LLM_CACHE_COMPOSE = getattr(config, "LLM_CACHE_COMPOSE", False)
+_LLM_CACHE = None
+
+def get_llm_cache() -> LLMCache | None:
+    global _LLM_CACHE
+    if not _LLM_CACHE_PATH: return None
+    with _openai_client_lock:
+        if _LLM_CACHE is None:
+            _LLM_CACHE = LLMCache(_LLM_CACHE_PATH, getattr(config, "LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600), getattr(config, "LLM_CACHE_MAX_ENTRIES", 10000))
+        return _LLM_CACHE
+
+def _chat_cached(fn: str, client, request: dict, parse, logger=None, cacheable: bool = True):
+    cache = get_llm_cache() if cacheable else None
+    key = cache.key(fn, request) if cache else None
+    if cache:
+        cached = cache.get(key)
+        if cached is not None:
+            _log(logger, f"[LLM] {fn}: cached response")
+            return cached
+    result = parse(client.chat.completions.create(**request), logger)
+    if cache: cache.put(key, fn, result)
+    return result
+
+# 비전 LLM에 보낼 이미지: 요청마다 한 번만 축소/재인코딩해 모든 LLM 호출이 같이 씁니다.
+# gpt-4o-mini는 detail=low면 512px, high여도 짧은 변 768px로 줄여 보므로 그보다 큰 업로드는 전송 낭비입니다.
+_LLM_IMAGE_MAX_SIDE = getattr(config, "LLM_IMAGE_MAX_SIDE", 768)
+_LLM_IMAGE_FORMAT = getattr(config, "LLM_IMAGE_FORMAT", "jpeg")  # jpeg / webp
+_LLM_IMAGE_QUALITY = getattr(config, "LLM_IMAGE_QUALITY", 85)
+_LLM_IMAGE_DETAIL = getattr(config, "LLM_IMAGE_DETAIL", "low")  # low / high / auto
+
+def prepare_llm_image(image) -> str:
+    """PIL 이미지를 비전 LLM 입력용 data URL(축소 + JPEG/WebP)로 만듭니다."""
+    image = image.convert("RGB")
+    if max(image.size) > _LLM_IMAGE_MAX_SIDE:
+        image = image.copy()
+        image.thumbnail((_LLM_IMAGE_MAX_SIDE, _LLM_IMAGE_MAX_SIDE))
+    buf = io.BytesIO()
+    image.save(buf, format=_LLM_IMAGE_FORMAT.upper(), quality=_LLM_IMAGE_QUALITY)
+    return f"data:image/{_LLM_IMAGE_FORMAT};base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
+
+_IMAGE_SIGNATURES = ((b"\x89PNG", "image/png"), (b"\xff\xd8", "image/jpeg"), (b"GIF8", "image/gif"))
+
+def _image_url(image: str) -> str:
+    """data URL은 그대로, 순수 base64는 실제 포맷(시그니처)에 맞는 MIME으로 감쌉니다."""
+    if image.startswith("data:"): return image
+    try: head = base64.b64decode(image[:16])
+    except (binascii.Error, ValueError): head = b""
+    mime = next((m for sig, m in _IMAGE_SIGNATURES if head.startswith(sig)), None)
+    if mime is None: mime = "image/webp" if head[:4] == b"RIFF" and head[8:12] == b"WEBP" else "image/jpeg"
+    return f"data:{mime};base64,{image}"
+
+def _image_part(image: str) -> dict:
+    return {"type": "image_url", "image_url": {"url": _image_url(image), "detail": _LLM_IMAGE_DETAIL}}
+
 def _log(logger, msg):
     if logger: logger.info(msg)
     else: print(msg)
@@ -28,13 +108,9 @@ def _validate_compose_json(obj: dict):
     if not isinstance(obj["interaction_detected"], bool): obj["interaction_detected"] = False
     return obj
 
-def _get_product_category_from_llm(prompt_text: str, product_image_b64: str | None, api_key: Optional[str], logger=None) -> str:
-    """사용자 프롬프트와 이미지를 기반으로 제품의 카테고리를 추론합니다."""
-    if not (api_key and _HAS_OPENAI and OpenAI): raise RuntimeError("OpenAI not available")
-    client = OpenAI(api_key=api_key)
-
-    _log(logger, "Asking LLM to determine product category...")
+# 각 LLM 호출은 (요청 kwargs 만들기 → 응답 해석) 두 부분으로 나눠, _chat_cached가 요청 kwargs로 캐시 키를 만들고 해석된 결과를 캐시하게 합니다.
 
+def _category_request(prompt_text: str, product_image_b64: str | None) -> dict:
     content = []
     user_prompt = (
         f"Analyze the following user request and the attached image to determine the main product's category.\n\n"
@@ -43,47 +119,45 @@ def _get_product_category_from_llm(prompt_text: str, product_image_b64: str | No
     content.append({"type": "text", "text": user_prompt})
 
     if product_image_b64:
-        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{product_image_b64}", "detail": "low"}})
+        content.append(_image_part(product_image_b64))
 
     sys_prompt = (
         "You are a product category classifier. Based on the user's text and image, classify the product into ONE of the following categories: "
         "'food', 'cosmetics', 'fashion', 'electronics', 'furniture', 'other'. "
         "Respond with ONLY the single category name in lowercase (e.g., 'food')."
     )
+    return dict(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": sys_prompt},
+            {"role": "user", "content": content}
+        ],
+        max_tokens=10,
+        timeout=_CLASSIFY_TIMEOUT,
+    )
+
+def _parse_category(resp, logger=None) -> str:
+    category = resp.choices[0].message.content.strip().lower()
 
+    valid_categories = ['food', 'cosmetics', 'fashion', 'electronics', 'furniture', 'other']
+    if category not in valid_categories:
+        _log(logger, f"LLM returned an invalid category: '{category}'. Defaulting to 'other'.")
+        return 'other'
+
+    _log(logger, f"LLM determined product category: {category}")
+    return category
+
+def _get_product_category_from_llm(prompt_text: str, product_image_b64: str | None, api_key: Optional[str], logger=None) -> str:
+    """사용자 프롬프트와 이미지를 기반으로 제품의 카테고리를 추론합니다."""
+    client = get_openai_client(api_key)
+    _log(logger, "Asking LLM to determine product category...")
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": sys_prompt},
-                {"role": "user", "content": content}
-            ],
-            max_tokens=10,
-        )
-        category = resp.choices[0].message.content.strip().lower()
-        
-        valid_categories = ['food', 'cosmetics', 'fashion', 'electronics', 'furniture', 'other']
-        if category not in valid_categories:
-            _log(logger, f"LLM returned an invalid category: '{category}'. Defaulting to 'other'.")
-            return 'other'
-            
-        _log(logger, f"LLM determined product category: {category}")
-        return category
+        return _chat_cached("category", client, _category_request(prompt_text, product_image_b64), _parse_category, logger)
     except Exception as e:
         _log(logger, f"Could not determine product category from LLM: {e}. Falling back to 'other'.")
         return 'other'
 
-def _get_model_type_from_llm(model_image_b64: str | None, api_key: Optional[str], logger=None) -> str:
-    """AI Vision을 사용해 이미지 속 모델이 'human'인지 'animal'인지 분류합니다."""
-    if not model_image_b64:
-        _log(logger, "No model image provided, defaulting model type to 'human'.")
-        return 'human'
-    if not (api_key and _HAS_OPENAI and OpenAI):
-        raise RuntimeError("OpenAI not available")
-    
-    client = OpenAI(api_key=api_key)
-    _log(logger, "Asking LLM with Vision to determine model type (human/animal)...")
-
+def _model_type_request(model_image_b64: str) -> dict:
     content = [
         {
             "type": "text",
@@ -92,37 +166,39 @@ def _get_model_type_from_llm(model_image_b64: str | None, api_key: Optional[str]
                 "Respond with ONLY the single word 'human' or 'animal' in lowercase."
             )
         },
-        {
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{model_image_b64}",
-                "detail": "low"
-            }
-        }
+        _image_part(model_image_b64),
     ]
+    return dict(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": content}],
+        max_tokens=10,
+        timeout=_CLASSIFY_TIMEOUT,
+    )
+
+def _parse_model_type(resp, logger=None) -> str:
+    model_type = resp.choices[0].message.content.strip().lower()
+
+    if model_type not in ['human', 'animal']:
+        _log(logger, f"LLM returned an invalid model type: '{model_type}'. Defaulting to 'human'.")
+        return 'human'
 
+    _log(logger, f"LLM Vision determined model type: {model_type}")
+    return model_type
+
+def _get_model_type_from_llm(model_image_b64: str | None, api_key: Optional[str], logger=None) -> str:
+    """AI Vision을 사용해 이미지 속 모델이 'human'인지 'animal'인지 분류합니다."""
+    if not model_image_b64:
+        _log(logger, "No model image provided, defaulting model type to 'human'.")
+        return 'human'
+    client = get_openai_client(api_key)
+    _log(logger, "Asking LLM with Vision to determine model type (human/animal)...")
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": content}],
-            max_tokens=10,
-        )
-        model_type = resp.choices[0].message.content.strip().lower()
-        
-        if model_type not in ['human', 'animal']:
-            _log(logger, f"LLM returned an invalid model type: '{model_type}'. Defaulting to 'human'.")
-            return 'human'
-            
-        _log(logger, f"LLM Vision determined model type: {model_type}")
-        return model_type
+        return _chat_cached("model_type", client, _model_type_request(model_image_b64), _parse_model_type, logger)
     except Exception as e:
         _log(logger, f"Could not determine model type from LLM Vision: {e}. Falling back to 'human'.")
         return 'human'
 
-def _llm_compose_prompt_from_inputs(prompt_context: dict, product_image: str | None, model_image: str | None, api_key: Optional[str], logger=None) -> dict:
-    if not (api_key and _HAS_OPENAI and OpenAI): raise RuntimeError("OpenAI not available")
-    client = OpenAI(api_key=api_key)
-    
+def _compose_request(prompt_context: dict, product_image: str | None, model_image: str | None) -> dict:
     content = []
     
     category = prompt_context.get("product_category", "default")
@@ -152,9 +228,9 @@ def _llm_compose_prompt_from_inputs(prompt_context: dict, product_image: str | N
     content.append({"type": "text", "text": user_text})
 
     if product_image:
-        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{product_image}"}})
+        content.append(_image_part(product_image))
     if model_image:
-        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{model_image}"}})
+        content.append(_image_part(model_image))
     
     sys = (
         "First, analyze the user's 'core_request' to determine if it describes a direct physical interaction between the subject and a product. "
@@ -164,34 +240,40 @@ def _llm_compose_prompt_from_inputs(prompt_context: dict, product_image: str | N
         "{\"final_prompt_en\": string, \"keywords_kor\": [string], \"negatives_en\": [string], \"interaction_detected\": boolean}"
     )
 
-    model_to_use = "gpt-4o-mini"
-    _log(logger, f"[LLM] Acting as AI Creative Director with model: {model_to_use}")
-
-    resp = client.chat.completions.create(
-        model=model_to_use,
+    return dict(
+        model="gpt-4o-mini",
         messages=[{"role": "system", "content": sys}, {"role": "user", "content": content}],
         max_tokens=500,
         response_format={"type":"json_object"},
+        timeout=_COMPOSE_TIMEOUT,
     )
+
+def _parse_compose(resp, logger=None) -> dict:
     raw = resp.choices[0].message.content.strip()
     data = _validate_compose_json(json.loads(raw))
     _log(logger, f"[PROMPT/LLM] JSON ok: keys={list(data.keys())}")
     return data
 
+def _llm_compose_prompt_from_inputs(prompt_context: dict, product_image: str | None, model_image: str | None, api_key: Optional[str], logger=None) -> dict:
+    client = get_openai_client(api_key)
+    request = _compose_request(prompt_context, product_image, model_image)
+    _log(logger, f"[LLM] Acting as AI Creative Director with model: {request['model']}")
+    return _chat_cached("compose", client, request, _parse_compose, logger, cacheable=_LLM_CACHE_COMPOSE)
+
 def get_relative_scale_from_llm(model_image: str, product_image: str, api_key: Optional[str], logger=None) -> float:
-    if not (api_key and _HAS_OPENAI and OpenAI): raise RuntimeError("OpenAI not available")
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
     _log(logger, "Asking LLM to determine relative scale of product to model...")
     content = [
         {"type": "text", "text": "You are a precise photo editor. Look at the two images provided... Respond with ONLY a single float number..."}, # 프롬프트 일부 생략
-        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{model_image}", "detail": "low"}},
-        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{product_image}", "detail": "low"}},
+        _image_part(model_image),
+        _image_part(product_image),
     ]
     try:
         resp = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": content}],
             max_tokens=10,
+            timeout=_CLASSIFY_TIMEOUT,
         )
         response_text = resp.choices[0].message.content.strip()
         scale = float(response_text)
@@ -201,12 +283,67 @@ def get_relative_scale_from_llm(model_image: str, product_image: str, api_key: O
         _log(logger, f"Could not determine relative scale from LLM: {e}. Falling back to default scale.")
         return 0.3
 
+# 텍스트 인코더 조합별 (prompt_embeds, pooled) LRU 캐시. 인코더가 내려가면 해당 캐시도 함께 사라집니다.
+_PROMPT_EMBED_CACHE = weakref.WeakKeyDictionary()
+_PINNED_PROMPT_EMBEDS = weakref.WeakKeyDictionary()
+_PROMPT_EMBED_CACHE_SIZE = getattr(config, "PROMPT_EMBED_CACHE_SIZE", 128)
+_prompt_cache_lock = threading.Lock()
+
+def _encoder_key(pipe):
+    te2 = getattr(pipe, "text_encoder_2", None) or getattr(pipe, "text_encoder", None)
+    te1 = getattr(pipe, "text_encoder", None) if getattr(pipe, "text_encoder_2", None) is not None else None
+    return te2, (id(te1) if te1 is not None else None)
+
+def _cached_text_embeds(pipe, text: str):
+    te, te1_id = _encoder_key(pipe)
+    key = (te1_id, text)
+    with _prompt_cache_lock:
+        pinned = _PINNED_PROMPT_EMBEDS.get(te, {})
+        if key in pinned: return pinned[key]
+        lru = _PROMPT_EMBED_CACHE.setdefault(te, OrderedDict())
+        if key in lru:
+            lru.move_to_end(key); return lru[key]
+    prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(prompt=text, num_images_per_prompt=1, do_classifier_free_guidance=False)
+    with _prompt_cache_lock:
+        lru[key] = (prompt_embeds, pooled_prompt_embeds)
+        while len(lru) > _PROMPT_EMBED_CACHE_SIZE: lru.popitem(last=False)
+    return prompt_embeds, pooled_prompt_embeds
+
+def precompute_prompt_embeds(pipe, text: str):
+    """고정 문구(예: 네거티브 프롬프트)를 로드 시점에 인코딩해 LRU에서 밀려나지 않게 고정합니다."""
+    te, te1_id = _encoder_key(pipe)
+    with _prompt_cache_lock:
+        if (te1_id, text) in _PINNED_PROMPT_EMBEDS.get(te, {}): return
+    embeds = _cached_text_embeds(pipe, text)
+    with _prompt_cache_lock:
+        _PINNED_PROMPT_EMBEDS.setdefault(te, {})[(te1_id, text)] = embeds
+
 def encode_prompt_sdxl(pipe, prompt, negative_prompt):
-    (prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds) = pipe.encode_prompt(
-        prompt=prompt, num_images_per_prompt=1, do_classifier_free_guidance=True, negative_prompt=negative_prompt)
+    prompt_embeds, pooled_prompt_embeds = _cached_text_embeds(pipe, prompt)
+    negative_prompt_embeds, negative_pooled_prompt_embeds = _cached_text_embeds(pipe, negative_prompt)
     return { "prompt_embeds": prompt_embeds, "negative_prompt_embeds": negative_prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds, "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds }
 
-def build_ad_prompt_compose(tokenizer, raw_inputs: dict, *, logger=None, openai_api_key: Optional[str]=None) -> dict:
+def text_encoder_2_embeds(embeds: dict, dim: int) -> dict:
+    """
+    encode_prompt_sdxl 결과(텍스트 인코더 1/2 hidden state를 이어 붙인 것)에서
+    text_encoder_2 부분(마지막 dim 채널)만 잘라 리파이너용 임베딩으로 만듭니다. pooled는 원래 text_encoder_2 출력입니다.
+    """
+    return {
+        "prompt_embeds": embeds["prompt_embeds"][..., -dim:],
+        "negative_prompt_embeds": embeds["negative_prompt_embeds"][..., -dim:],
+        "pooled_prompt_embeds": embeds["pooled_prompt_embeds"],
+        "negative_pooled_prompt_embeds": embeds["negative_pooled_prompt_embeds"],
+    }
+
+def _fallback_compose(prompt: str | None) -> dict:
+    return {
+        "final_prompt_en": f"a high-quality commercial photograph of a product, related to '{prompt or 'something'}', clean studio background",
+        "keywords_kor": [],
+        "negatives_en": [],
+        "interaction_detected": False
+    }
+
+def _compose_briefing(raw_inputs: dict):
     prompt = raw_inputs.get("prompt")
     params = raw_inputs.get("params", {})
     
@@ -222,6 +359,11 @@ def build_ad_prompt_compose(tokenizer, raw_inputs: dict, *, logger=None, openai_
     
     if params.get("brand_name"): briefing["brand"] = params.get("brand_name")
     if params.get("target") or params.get("model_alias"): briefing["subject"] = params.get("target") or params.get("model_alias")
+    return briefing, product_image, model_image
+
+def build_ad_prompt_compose(tokenizer, raw_inputs: dict, *, logger=None, openai_api_key: Optional[str]=None) -> dict:
+    prompt = raw_inputs.get("prompt")
+    briefing, product_image, model_image = _compose_briefing(raw_inputs)
 
     try:
         data = _llm_compose_prompt_from_inputs(briefing, product_image, model_image, openai_api_key, logger=logger)
@@ -229,9 +371,4 @@ def build_ad_prompt_compose(tokenizer, raw_inputs: dict, *, logger=None, openai_
         return data
     except Exception as e:
         _log(logger, f"[ERROR] Prompt composition by AI Director failed: {e}. Falling back to a simple prompt.")
-        return {
-            "final_prompt_en": f"a high-quality commercial photograph of a product, related to '{prompt or 'something'}', clean studio background",
-            "keywords_kor": [],
-            "negatives_en": [],
-            "interaction_detected": False
-        }
\ No newline at end of file
+        return _fallback_compose(prompt)
@@ -0,0 +1,94 @@
+# =======================================
+# rembg_sessions.py — 설정 가능한 ONNX Runtime 세션 풀 (rembg 배경 제거)
+# =======================================
+# 세션 하나를 모든 요청이 돌려 쓰면 배경 제거가 직렬화되므로,
+# 스레드 수를 나눠 가진 세션 N개를 풀로 두고 요청마다 하나씩 빌려 씁니다.
+#
+# config:
+#   REMBG_MODEL              rembg 모델 이름 (u2net / u2netp / silueta / isnet-general-use / birefnet-general-lite ...)
+#                            REMBG_MODEL_PATH만 있으면 u2net_custom
+#   REMBG_MODEL_PATH         로컬 ONNX 파일 (지정 시 모델 다운로드 대신 사용)
+#   REMBG_QUANTIZE_INT8      True면 동적 int8 양자화본({모델}.int8.onnx)을 만들어 사용
+#                            (로컬 파일은 전처리가 같은 rembg *_custom 세션으로 열므로 _CUSTOM_SESSIONS에 있는 모델만 가능)
+#   REMBG_PROVIDERS          실행 프로바이더 목록 (기본 ["CPUExecutionProvider"])
+#   REMBG_SESSION_POOL_SIZE  세션 개수 (기본 2)
+#   REMBG_INTRA_OP_THREADS   세션당 intra-op 스레드 (기본 CPU 코어 수 / 풀 크기)
+#   REMBG_INTER_OP_THREADS   세션당 inter-op 스레드 (기본 1)
+# =======================================
+
+import os
+import queue
+from contextlib import contextmanager
+
+def _quantized(model_path: str, logger=None) -> str:
+    out_path = f"{os.path.splitext(model_path)[0]}.int8.onnx"
+    if not os.path.exists(out_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        if logger: logger.info(f"Quantizing rembg model to int8: {out_path}")
+        tmp = f"{out_path}.{os.getpid()}.tmp"
+        quantize_dynamic(model_path, tmp, weight_type=QuantType.QUInt8)
+        os.replace(tmp, out_path)
+    return out_path
+
+# 로컬 ONNX 파일을 같은 전처리/후처리로 열 수 있는 rembg 세션
+_CUSTOM_SESSIONS = {
+    "u2net": "u2net_custom", "u2netp": "u2net_custom", "silueta": "u2net_custom", "u2net_human_seg": "u2net_custom",
+    "isnet-general-use": "dis_custom", "isnet-anime": "dis_custom",
+}
+
+def _session_class(model_name: str):
+    from rembg.sessions import sessions_class
+    session_class = next((sc for sc in sessions_class if sc.name() == model_name), None)
+    if session_class is None: raise ValueError(f"Unknown rembg model '{model_name}'")
+    return session_class
+
+def _new_session(model_name: str, sess_opts, providers: list[str], model_path: str | None = None):
+    """
+    rembg.new_session과 같은 세션 클래스 생성자를 쓰되, 우리 SessionOptions(스레드 수)를 넘깁니다.
+    (rembg 2.0.x의 new_session은 SessionOptions를 스스로 만들고 OMP_NUM_THREADS만 반영합니다.)
+    """
+    kwargs = {"providers": providers}
+    if model_path: kwargs["model_path"] = model_path
+    return _session_class(model_name)(model_name, sess_opts, **kwargs)
+
+class RembgSessionPool:
+    def __init__(self, config, logger=None):
+        import onnxruntime as ort
+
+        self.logger = logger
+        model_path = getattr(config, "REMBG_MODEL_PATH", None)
+        self.model_name = getattr(config, "REMBG_MODEL", None) or ("u2net_custom" if model_path else "u2net")
+        if getattr(config, "REMBG_QUANTIZE_INT8", False):
+            custom_name = self.model_name if self.model_name.endswith("_custom") else _CUSTOM_SESSIONS.get(self.model_name)
+            if custom_name is None: raise ValueError(f"REMBG_QUANTIZE_INT8 is not supported for rembg model '{self.model_name}'")
+            model_path = _quantized(model_path or _session_class(self.model_name).download_models(), logger)
+            self.model_name = custom_name
+        elif model_path and not self.model_name.endswith("_custom"):
+            if self.model_name not in _CUSTOM_SESSIONS: raise ValueError(f"REMBG_MODEL_PATH is not supported for rembg model '{self.model_name}'")
+            self.model_name = _CUSTOM_SESSIONS[self.model_name]
+        self.model_path = model_path  # None이면 rembg가 받아 둔 기본 가중치
+
+        self.size = max(1, int(getattr(config, "REMBG_SESSION_POOL_SIZE", 2)))
+        self.providers = list(getattr(config, "REMBG_PROVIDERS", None) or ["CPUExecutionProvider"])
+        self.uses_gpu = any(p != "CPUExecutionProvider" for p in self.providers)
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = int(getattr(config, "REMBG_INTRA_OP_THREADS", None) or max(1, (os.cpu_count() or 1) // self.size))
+        sess_opts.inter_op_num_threads = int(getattr(config, "REMBG_INTER_OP_THREADS", 1))
+        sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self._sessions = queue.Queue()
+        for _ in range(self.size):
+            self._sessions.put(_new_session(self.model_name, sess_opts, self.providers, model_path))
+        if logger:
+            logger.info(f"rembg session pool ready: model={self.model_name} ({os.path.basename(model_path) if model_path else 'default weights'}), sessions={self.size}, providers={self.providers}, intra_op_threads={sess_opts.intra_op_num_threads}")
+
+    @contextmanager
+    def session(self):
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+    def stats(self) -> dict:
+        return {"model": self.model_name, "sessions": self.size, "idle": self._sessions.qsize(), "providers": self.providers}
@@ -0,0 +1,93 @@
+# =======================================
+# result_cache.py — 결정적 요청의 최종 결과 캐시
+# =======================================
+# 시드를 명시한 요청은 (이미지, 프롬프트, 파라미터, 모델 구성)이 같으면 같은 결과가 나오므로
+# 입력 지문(fingerprint) 해시로 최종 인코딩 바이트와 메타 정보를 디스크에 보관합니다.
+# 디렉토리 구조: {dir}/{key[:2]}/{key}.bin + {key}.json, 마지막 사용 시각(mtime) 기준 LRU로 용량을 지킵니다.
+# =======================================
+
+import os
+import json
+import hashlib
+import threading
+
+# 결과 모양에만 영향을 주고 이미지 내용과 무관한 파라미터
+_IGNORED_PARAMS = ("file_saved", "artifact_level", "timings")
+
+def fingerprint(inputs: dict, context: dict | None = None) -> str | None:
+    """요청 입력의 정규화된 해시. 시드가 없으면(비결정적) None."""
+    params = inputs.get("params") or {}
+    if params.get("seed") is None: return None
+    h = hashlib.blake2b(digest_size=20)
+    for name in ("product_image", "model_image"):
+        b64 = (inputs.get(name) or "").split(",", 1)[-1].strip().rstrip("=")
+        h.update(hashlib.blake2b(b64.encode(), digest_size=20).digest())
+    canonical = {
+        "prompt": inputs.get("prompt"),
+        "params": {k: v for k, v in params.items() if k not in _IGNORED_PARAMS},
+        "context": context or {},
+    }
+    h.update(json.dumps(canonical, sort_keys=True, ensure_ascii=False, default=str).encode())
+    return h.hexdigest()
+
+class ResultCache:
+    def __init__(self, disk_dir: str, max_disk_mb: float = 1024, logger=None):
+        self.disk_dir, self.logger = disk_dir, logger
+        self.max_disk_bytes = int(max_disk_mb * 1024**2)
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+        os.makedirs(self.disk_dir, exist_ok=True)
+        self._disk_bytes = sum(os.path.getsize(p) for p in self._files())
+
+    def _files(self) -> list[str]:
+        return [os.path.join(d, name) for d, _, names in os.walk(self.disk_dir) for name in names if name.endswith((".bin", ".json"))]
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = os.path.join(self.disk_dir, key[:2], key)
+        return f"{base}.bin", f"{base}.json"
+
+    def get(self, key: str) -> tuple[dict, bytes] | None:
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f: meta = json.load(f)
+            with open(data_path, "rb") as f: data = f.read()
+            os.utime(data_path); os.utime(meta_path)
+        except (FileNotFoundError, ValueError, OSError):
+            with self._lock: self.misses += 1
+            return None
+        with self._lock: self.hits += 1
+        return meta, data
+
+    def put(self, key: str, meta: dict, data: bytes):
+        data_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        encoded_meta = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+        suffix = f".{threading.get_ident()}.tmp"
+        # 메타 파일이 마지막에 생기므로 get()은 완성된 항목만 보게 됩니다.
+        for path, content in ((data_path, data), (meta_path, encoded_meta)):
+            with open(path + suffix, "wb") as f: f.write(content)
+            os.replace(path + suffix, path)
+        with self._lock:
+            self._disk_bytes += len(data) + len(encoded_meta)
+            if self._disk_bytes > self.max_disk_bytes: self._evict()
+
+    def _evict(self):
+        # 마지막 사용 시각(mtime) 기준으로 가장 오래된 항목부터 지웁니다.
+        entries = {}
+        for path in self._files():
+            try: st = os.stat(path)
+            except FileNotFoundError: continue
+            key = os.path.splitext(os.path.basename(path))[0]
+            mtime, size, paths = entries.get(key, (0, 0, []))
+            entries[key] = (max(mtime, st.st_mtime), size + st.st_size, paths + [path])
+        self._disk_bytes = sum(size for _, size, _ in entries.values())
+        for mtime, size, paths in sorted(entries.values()):
+            if self._disk_bytes <= self.max_disk_bytes * 0.9: break
+            for path in paths:
+                try: os.remove(path)
+                except FileNotFoundError: pass
+            self._disk_bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "disk_mb": round(self._disk_bytes / 1024**2, 1)}
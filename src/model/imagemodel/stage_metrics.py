@@ -0,0 +1,102 @@
+# =======================================
+# stage_metrics.py — 단계별 실행 시간/자원 계측 + Prometheus 히스토그램
+# =======================================
+# 요청 한 건이 LLM 호출, 모델 로드, 배경 디퓨전, rembg, DINO, ControlNet 디퓨전, VAE 디코드, 리파이너, 인코딩 중
+# 어디에 시간을 쓰는지 보기 위해 단계마다 벽시계 시간, GPU 시간(CUDA 이벤트), 최대 GPU 메모리를 기록합니다.
+# 기록 대상(요청별 StageTimings)은 contextvar로 전달되므로 단계 코드는 stage("이름")으로 감싸기만 하면 되고,
+# 배치로 실행되는 단계(base/리파이너)는 묶인 요청 모두에 같은 값이 기록됩니다.
+# 단계는 겹칠 수 있습니다 (예: composite 안의 dino, rembg). GPU 계측(gpu=True)은 장치 잠금 안의 단계에만 씁니다.
+# =======================================
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+import torch
+from prometheus_client import Histogram
+
+_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+_MEMORY_BUCKETS = tuple(gb * 1024**3 for gb in (1, 2, 4, 6, 8, 10, 12, 16, 20, 24, 32, 40, 48, 64, 80))
+
+STAGE_SECONDS = Histogram("image_pipeline_stage_seconds", "Wall time spent in each pipeline stage per request", ["stage"], buckets=_SECONDS_BUCKETS)
+STAGE_GPU_SECONDS = Histogram("image_pipeline_stage_gpu_seconds", "GPU time (CUDA events) spent in each pipeline stage per request", ["stage"], buckets=_SECONDS_BUCKETS)
+STAGE_PEAK_MEMORY = Histogram("image_pipeline_stage_peak_gpu_memory_bytes", "Peak allocated GPU memory during each pipeline stage", ["stage"], buckets=_MEMORY_BUCKETS)
+REQUEST_SECONDS = Histogram("image_pipeline_request_seconds", "End-to-end time of a generation request", ["outcome"], buckets=_SECONDS_BUCKETS)
+
+_current = contextvars.ContextVar("stage_timings", default=())
+_local = threading.local()
+
+class StageTimings:
+    """요청 한 건의 단계 기록. CPU/I/O 풀의 여러 스레드에서 동시에 추가될 수 있습니다."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.records = []
+        self._lock = threading.Lock()
+        self._observed = False
+
+    def add(self, stage: str, wall_seconds: float, gpu_seconds: float | None = None, peak_memory_bytes: int | None = None):
+        with self._lock: self.records.append((stage, wall_seconds, gpu_seconds, peak_memory_bytes))
+
+    def summary(self) -> dict:
+        """단계 이름별로 합산합니다 (시간은 합, 최대 메모리는 최댓값)."""
+        with self._lock: records = list(self.records)
+        stages = {}
+        for stage, wall, gpu, peak in records:
+            s = stages.setdefault(stage, {"calls": 0, "wall_ms": 0.0})
+            s["calls"] += 1
+            s["wall_ms"] += wall * 1000
+            if gpu is not None: s["gpu_ms"] = s.get("gpu_ms", 0.0) + gpu * 1000
+            if peak is not None: s["peak_gpu_memory_mb"] = max(s.get("peak_gpu_memory_mb", 0.0), peak / 1024**2)
+        for s in stages.values():
+            for k in ("wall_ms", "gpu_ms", "peak_gpu_memory_mb"):
+                if k in s: s[k] = round(s[k], 1)
+        return {"total_ms": round((time.perf_counter() - self.started) * 1000, 1), "stages": stages}
+
+    def observe(self, outcome: str):
+        """요청이 끝날 때 Prometheus 히스토그램에 반영합니다. 두 번째 호출부터는 무시합니다."""
+        with self._lock:
+            if self._observed: return
+            self._observed, records = True, list(self.records)
+        for stage, wall, gpu, peak in records:
+            STAGE_SECONDS.labels(stage).observe(wall)
+            if gpu is not None: STAGE_GPU_SECONDS.labels(stage).observe(gpu)
+            if peak is not None: STAGE_PEAK_MEMORY.labels(stage).observe(peak)
+        REQUEST_SECONDS.labels(outcome).observe(time.perf_counter() - self.started)
+
+@contextmanager
+def recording(*timings: StageTimings):
+    """이 블록 안(과 여기서 StageScheduler로 넘긴 작업)의 stage() 기록을 timings 모두에 남깁니다."""
+    token = _current.set(tuple(timings))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def stage(name: str, gpu: bool = False):
+    targets = _current.get()
+    if not targets:
+        yield
+        return
+    cuda = gpu and torch.cuda.is_available()
+    # GPU 단계가 겹치면 바깥 단계의 최대 메모리 기록을 지우지 않도록 가장 바깥에서만 초기화합니다.
+    outermost = cuda and not getattr(_local, "gpu_stage", False)
+    if outermost:
+        _local.gpu_stage = True
+        torch.cuda.reset_peak_memory_stats()
+    if cuda:
+        start_event, end_event = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        start_event.record()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        gpu_seconds = peak = None
+        if cuda:
+            end_event.record()
+            end_event.synchronize()
+            gpu_seconds = start_event.elapsed_time(end_event) / 1000
+            peak = torch.cuda.max_memory_allocated()
+        if outermost: _local.gpu_stage = False
+        wall = time.perf_counter() - started
+        for timings in targets: timings.add(name, wall, gpu_seconds, peak)
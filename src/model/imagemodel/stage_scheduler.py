@@ -0,0 +1,74 @@
+# =======================================
+# stage_scheduler.py — CPU 단계 워커 풀 + GPU 단계 장치 잠금
+# =======================================
+# 요청 준비 중 LLM 호출, rembg, 합성, Canny 같은 CPU/네트워크 단계는 워커 풀에서 동시에 돌리고,
+# 모델 로드/디퓨전/탐지 같은 GPU 단계는 장치 잠금 하나로 직렬화합니다.
+# 한 배치가 GPU를 쓰는 동안 다음 배치의 CPU 준비가 진행되므로 GPU가 쉬는 시간이 줄고,
+# 동시 요청이 ModelManager 캐시와 VRAM을 두고 경합하지 않습니다.
+# 요청 하나 안에서도 LLM 호출 같은 네트워크 대기는 별도 I/O 풀에 미리 띄워 두고(submit_io)
+# 배경 디퓨전 등 다른 단계가 도는 동안 기다리게 합니다. (CPU 풀 작업이 CPU 풀을 기다리며 막히지 않도록 풀을 나눕니다.)
+# 풀에 넘긴 작업은 제출한 쪽의 contextvars를 이어받습니다 (단계 계측 기록 대상 전달용).
+# =======================================
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+
+class StageScheduler:
+    def __init__(self, cpu_workers: int = 4, io_workers: int = 8, logger=None):
+        self.logger = logger
+        self.cpu_workers = max(1, int(cpu_workers))
+        self.cpu_pool = ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix="cpu-stage")
+        self.io_pool = ThreadPoolExecutor(max_workers=max(1, int(io_workers)), thread_name_prefix="io-stage")
+        # GPU 단계 안에서 다시 GPU 단계를 부를 수 있도록(예: 로드 → 추론) 재진입 잠금을 씁니다.
+        self._gpu_lock = threading.RLock()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.gpu_busy_seconds, self.gpu_wait_seconds = 0.0, 0.0
+        self._started_at = time.time()
+
+    @contextmanager
+    def gpu(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth:
+            self._local.depth += 1
+            try: yield
+            finally: self._local.depth -= 1
+            return
+        requested = time.perf_counter()
+        with self._gpu_lock:
+            acquired = time.perf_counter()
+            self._local.depth = 1
+            try:
+                yield
+            finally:
+                self._local.depth = 0
+                with self._stats_lock:
+                    self.gpu_wait_seconds += acquired - requested
+                    self.gpu_busy_seconds += time.perf_counter() - acquired
+
+    def map_cpu(self, fn, items) -> list:
+        """items 각각에 fn을 CPU 워커 풀에서 동시에 적용하고 입력 순서대로 결과를 돌려줍니다."""
+        items = list(items)
+        if len(items) <= 1: return [fn(item) for item in items]
+        futures = [self.cpu_pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    def submit_io(self, fn, *args, **kwargs) -> Future:
+        """
+        네트워크 대기 위주의 작업을 I/O 풀에 띄우고 Future를 돌려줍니다.
+        풀은 제출 순서대로 작업을 시작하므로, 작업 안에서는 자신보다 먼저 제출된 Future만 기다려야 합니다.
+        """
+        return self.io_pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            elapsed = max(time.time() - self._started_at, 1e-9)
+            return {
+                "cpu_workers": self.cpu_workers,
+                "gpu_busy_seconds": round(self.gpu_busy_seconds, 1),
+                "gpu_wait_seconds": round(self.gpu_wait_seconds, 1),
+                "gpu_utilization": round(self.gpu_busy_seconds / elapsed, 3),
+            }
@@ -17,6 +17,7 @@ from typing import Dict, Any
 from asyncio import Semaphore
 import httpx
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from pathlib import Path
 from logging.handlers import RotatingFileHandler
@@ -31,6 +32,11 @@ load_dotenv(dotenv_path)
 # 주요 API 엔드포인트 URL
 TEXT_API_URL = os.getenv("TEXT_API_URL", "http://34.123.118.58:8080/generate")
 IMAGE_API_URL_JSON = os.getenv("IMAGE_API_URL_JSON", "http://34.123.118.58:8090/generate_image")
+# 비동기 작업 API (POST /jobs → GET /jobs/{id} 폴링). IMAGE_API_USE_JOBS를 켜야 /infer/image가 이를 사용 (기본: 기존 /generate_image 동기 호출)
+IMAGE_API_JOBS_URL = os.getenv("IMAGE_API_JOBS_URL", IMAGE_API_URL_JSON.rsplit("/generate_image", 1)[0] + "/jobs")
+IMAGE_API_USE_JOBS = os.getenv("IMAGE_API_USE_JOBS", "false").lower() in ("1", "true", "yes")
+IMAGE_JOB_TIMEOUT = int(os.getenv("IMAGE_JOB_TIMEOUT", 600))
+IMAGE_JOB_POLL_INTERVAL = float(os.getenv("IMAGE_JOB_POLL_INTERVAL", 2.0))
 BACKEND_API_URL = os.getenv("BACKEND_API_URL", "http://localhost:9000/generations/")
 BACKEND_API_TOKEN = os.getenv("BACKEND_API_TOKEN", "")
 
@@ -120,9 +126,55 @@ async def call_image_api(payload: Dict[str, Any]) -> Dict[str, Any]:
     """
     이미지 API 호출
     """
+    if IMAGE_API_USE_JOBS:
+        return await call_image_job_api(payload)
     return await call_api_with_retry(IMAGE_API_URL_JSON, payload, timeout=300)
 
 
+async def submit_image_job_api(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    이미지 작업 제출 (재시도 없음)
+    응답 전에 타임아웃이 나도 서버에는 이미 작업이 들어갔을 수 있으므로, 다시 보내 GPU 작업을 중복 생성하지 않음
+    """
+    async with httpx.AsyncClient(timeout=30) as client:
+        res = await client.post(IMAGE_API_JOBS_URL, json=payload)
+        res.raise_for_status()
+        return res.json()
+
+
+async def call_image_job_api(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    이미지 작업 API 호출: 작업을 제출하고 완료될 때까지 짧은 요청으로 폴링
+    (긴 생성 시간 동안 HTTP 연결을 붙잡고 있지 않음)
+    """
+    job = await submit_image_job_api(payload)
+    job_id = job["job_id"]
+    logging.info(f"이미지 작업 제출: {job_id}")
+    deadline = time.time() + IMAGE_JOB_TIMEOUT
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        while time.time() < deadline:
+            await asyncio.sleep(IMAGE_JOB_POLL_INTERVAL)
+            try:
+                res = await client.get(f"{IMAGE_API_JOBS_URL}/{job_id}")
+                if res.status_code in (404, 410):
+                    raise RuntimeError(f"이미지 작업을 찾을 수 없음 ({res.status_code}): {job_id}")
+                res.raise_for_status()
+            except httpx.HTTPError as e:
+                logging.warning(f"[작업 상태 조회 오류] {job_id}: {repr(e)}")
+                continue
+            status = res.json()
+            if status["status"] == "succeeded":
+                logging.info(f"이미지 작업 완료: {job_id}")
+                return status["result"]
+            if status["status"] == "failed":
+                raise RuntimeError(f"이미지 작업 실패: {status.get('error')}")
+            if status["status"] == "cancelled":
+                raise RuntimeError(f"이미지 작업 취소됨: {job_id}")
+
+    raise TimeoutError(f"이미지 작업 시간 초과: {job_id} ({IMAGE_JOB_TIMEOUT}s)")
+
+
 async def save_generation_history(record: Dict[str, Any], owner_id: int) -> None:
     """
     백엔드에 생성 기록 저장 (비동기)
@@ -178,6 +230,29 @@ async def infer_text(request: Request):
         return {"text": output_text, "success": True}
 
 
+def build_image_payload(body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    프론트 요청 본문을 검증하고 이미지 API 요청 payload로 변환
+    """
+    product_b64 = clean_base64(body.get("product_image", ""))
+    model_b64 = clean_base64(body.get("model_image", ""))
+
+    if not (product_b64 or model_b64):
+        raise HTTPException(status_code=400, detail="최소 한 개의 이미지(base64)가 필요합니다")
+
+    if product_b64 and not validate_base64(product_b64):
+        raise HTTPException(status_code=400, detail="product_image base64 형식이 올바르지 않습니다")
+    if model_b64 and not validate_base64(model_b64):
+        raise HTTPException(status_code=400, detail="model_image base64 형식이 올바르지 않습니다")
+
+    return {
+        "model_image": model_b64,
+        "product_image": product_b64,
+        "prompt": body.get("prompt", ""),
+        "params": body.get("params", {})
+    }
+
+
 @app.post("/infer/image")
 async def infer_image(request: Request):
     """
@@ -187,25 +262,8 @@ async def infer_image(request: Request):
         body = await request.json()
         owner_id = body.get("owner_id", 0)
 
-        product_b64 = clean_base64(body.get("product_image", ""))
-        model_b64 = clean_base64(body.get("model_image", ""))
-        prompt = body.get("prompt", "")
-        params = body.get("params", {})
-
-        if not (product_b64 or model_b64):
-            raise HTTPException(status_code=400, detail="최소 한 개의 이미지(base64)가 필요합니다")
-
-        if product_b64 and not validate_base64(product_b64):
-            raise HTTPException(status_code=400, detail="product_image base64 형식이 올바르지 않습니다")
-        if model_b64 and not validate_base64(model_b64):
-            raise HTTPException(status_code=400, detail="model_image base64 형식이 올바르지 않습니다")
-
-        payload = {
-            "model_image": model_b64,
-            "product_image": product_b64,
-            "prompt": prompt,
-            "params": params
-        }
+        payload = build_image_payload(body)
+        prompt, product_b64, model_b64 = payload["prompt"], payload["product_image"], payload["model_image"]
 
         try:
             image_result = await call_image_api(payload)
@@ -226,6 +284,98 @@ async def infer_image(request: Request):
         return image_result
 
 
+async def track_image_job(job_id: str, prompt: str, input_image: str, owner_id: int) -> None:
+    """
+    비동기 이미지 작업이 끝날 때까지 기다렸다가 생성 기록 저장
+    """
+    deadline = time.time() + IMAGE_JOB_TIMEOUT
+    async with httpx.AsyncClient(timeout=30) as client:
+        while time.time() < deadline:
+            await asyncio.sleep(IMAGE_JOB_POLL_INTERVAL)
+            try:
+                res = await client.get(f"{IMAGE_API_JOBS_URL}/{job_id}")
+                if res.status_code in (404, 410):
+                    logging.info(f"이미지 작업 종료 (HTTP {res.status_code}): {job_id}")
+                    return
+                res.raise_for_status()
+            except httpx.HTTPError as e:
+                logging.warning(f"[작업 상태 조회 오류] {job_id}: {repr(e)}")
+                continue
+            status = res.json()
+            if status["status"] == "succeeded":
+                await save_generation_history({
+                    "input_text": prompt,
+                    "input_image_path": input_image,
+                    "output_text": "",
+                    "output_image_path": status["result"].get("output_base64", ""),
+                }, owner_id)
+                return
+            if status["status"] in ("failed", "cancelled"):
+                logging.info(f"이미지 작업 종료 ({status['status']}): {job_id}")
+                return
+
+
+@app.post("/infer/image/jobs")
+async def submit_image_job(request: Request):
+    """
+    이미지 생성 작업 제출 (즉시 job_id 반환)
+    - 진행 상황: GET /infer/image/jobs/{job_id}/events (SSE)
+    - 상태/결과: GET /infer/image/jobs/{job_id}
+    """
+    body = await request.json()
+    owner_id = body.get("owner_id", 0)
+    payload = build_image_payload(body)
+
+    try:
+        job = await submit_image_job_api(payload)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"이미지 API 호출 실패: {str(e)}")
+
+    asyncio.create_task(track_image_job(job["job_id"], payload["prompt"], payload["product_image"] or payload["model_image"] or "", owner_id))
+    return job
+
+
+@app.get("/infer/image/jobs/{job_id}")
+async def get_image_job(job_id: str):
+    """
+    이미지 작업 상태/결과 조회 (이미지 API 응답 그대로 전달)
+    """
+    async with httpx.AsyncClient(timeout=30) as client:
+        res = await client.get(f"{IMAGE_API_JOBS_URL}/{job_id}")
+    if res.status_code != 200:
+        raise HTTPException(status_code=res.status_code, detail=res.text)
+    return res.json()
+
+
+@app.delete("/infer/image/jobs/{job_id}")
+async def cancel_image_job(job_id: str):
+    """
+    이미지 작업 취소
+    """
+    async with httpx.AsyncClient(timeout=30) as client:
+        res = await client.delete(f"{IMAGE_API_JOBS_URL}/{job_id}")
+    if res.status_code != 200:
+        raise HTTPException(status_code=res.status_code, detail=res.text)
+    return res.json()
+
+
+@app.get("/infer/image/jobs/{job_id}/events")
+async def relay_image_job_events(job_id: str):
+    """
+    이미지 API의 SSE 진행 이벤트(단계/스텝/미리보기)를 그대로 중계
+    """
+    async def relay():
+        async with httpx.AsyncClient(timeout=httpx.Timeout(30, read=None)) as client:
+            async with client.stream("GET", f"{IMAGE_API_JOBS_URL}/{job_id}/events") as res:
+                if res.status_code != 200:
+                    yield f"event: failed\ndata: {json.dumps({'type': 'failed', 'status_code': res.status_code})}\n\n"
+                    return
+                async for chunk in res.aiter_raw():
+                    yield chunk
+
+    return StreamingResponse(relay(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.post("/infer/all")
 async def infer_all(request: Request):
     """